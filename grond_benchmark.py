@@ -0,0 +1,646 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the GROND data QA viewer.
+
+Usage: python grond_benchmark.py <benchmark> [options]
+
+Each benchmark builds its own synthetic data in a temporary directory unless
+a real PATH is given, and prints its timings to stdout.
+'''
+import os
+import sys
+import re
+import time
+import shutil
+import sqlite3
+import tempfile
+import argparse
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0,BASEDIR)
+from lib import discovery
+from lib import targets
+
+FITS_REGEX = 'GROND_._OB_ana\.fits(\.fz|\.gz)?$'
+BANDS = 'grizJHK'
+
+
+def timed(func, *args, **kwargs):
+  start = time.time()
+  result = func(*args,**kwargs)
+  return time.time()-start, result
+
+
+def makeTree(root, depth, fanout, obs):
+  '''
+  Creates a synthetic reduced-data tree: depth levels of fanout directories, with
+  obs OB directories (each holding the 7 band subdirectories) in every leaf.
+  Returns the number of OBs created.
+  '''
+  n = 0
+  leaves = [root]
+  for level in range(depth):
+    leaves = [os.path.join(p,'d%s' % i) for p in leaves for i in range(fanout)]
+  for leaf in leaves:
+    for ob in range(obs):
+      for band in BANDS:
+        d = os.path.join(leaf,'OB%s_1' % ob,band)
+        os.makedirs(d)
+        open(os.path.join(d,'GROND_%s_OB_ana.fits' % band),'w').close()
+      n += 1
+  return n
+
+
+def legacyWalk(root):
+  '''
+  The original Application.initTargets walk, without the database part
+  '''
+  targets = []
+  for path, dirs, files in os.walk(root):
+    for f in files:
+      if re.search(FITS_REGEX,f):
+        img = os.path.join(os.path.abspath(path),f)
+        target = img[:re.search(FITS_REGEX,img).start()-2]
+        if target not in targets:
+          targets.append(target)
+  return targets
+
+
+def addLatency(seconds):
+  '''
+  Emulates the metadata round-trip of a network filesystem on every directory listing
+  '''
+  def slow(func):
+    def wrapper(path):
+      time.sleep(seconds)
+      return func(path)
+    return wrapper
+  os.listdir = slow(os.listdir)
+  if discovery.scandir is not None:
+    discovery.scandir = slow(discovery.scandir)
+
+
+def scanIndexDB():
+  db = sqlite3.connect(':memory:')
+  db.execute('CREATE TABLE ScanIndex (path TEXT PRIMARY KEY, mtime REAL, scanned REAL, pattern TEXT, subdirs TEXT, files TEXT)')
+  return db
+
+
+def legacyRegister(db, target):
+  '''
+  The original per-target registration of Application.initTargets
+  '''
+  SQL = 'INSERT INTO Flags (target, viewed, %s) VALUES (%s, 0, %s);'
+  SQL = SQL % (','.join([i for i in BANDS]), '"%s"' % target, ','.join(["0" for i in range(len(BANDS))]) )
+  SQL+= 'INSERT INTO MissingImages (target, %s) VALUES (%s, %s)'
+  SQL = SQL % (','.join([i for i in BANDS]), '"%s"' % target, ','.join(["0" for i in range(len(BANDS))]) )
+  db.executescript(SQL)
+  db.commit()
+
+
+def freshDatabase(app, tmp, name):
+  app.DATABASE = os.path.join(tmp,name)
+  app.initdb()
+  db = sqlite3.connect(app.DATABASE)
+  app.upgradedb(db)
+  return db
+
+
+def benchRegistration(args):
+  import grond_dataviewer as app
+  tmp = tempfile.mkdtemp(prefix='grond_bench_')
+  targets = ['/data/grond/run%s/OB%s_1' % (i//100,i) for i in range(args.targets)]
+  try:
+    db = freshDatabase(app,tmp,'legacy.db')
+    n = min(len(targets),args.legacy)
+    t, result = timed(lambda: [legacyRegister(db,target) for target in targets[:n]])
+    print "%-32s %8.3fs  %10.0f targets/s (%s targets)" % ('per-target executescript',t,n/t,n)
+    db = freshDatabase(app,tmp,'batched.db')
+    t, n = timed(app.registerTargets,db,targets)
+    print "%-32s %8.3fs  %10.0f targets/s (%s targets)" % ('registerTargets (executemany)',t,n/t,n)
+    t, n = timed(app.registerTargets,db,targets)
+    print "%-32s %8.3fs  %10.0f targets/s (%s new)" % ('registerTargets, all known',t,len(targets)/t,n)
+  finally:
+    shutil.rmtree(tmp)
+
+
+def perOp(func, items):
+  t, result = timed(lambda: [func(i) for i in items])
+  return t/len(items)
+
+
+def benchRegistry(args):
+  import random
+  random.seed(42)
+  for n in args.sizes:
+    names = ['/data/grond/run%s/OB%s_1' % (i//100,i) for i in range(n)]
+    sample = random.sample(names,min(n,args.sample))
+    L = list(names)
+    registry = targets.TargetRegistry(names)
+    print "%s targets:" % n
+    rows = [
+      ('membership (target in ...)', lambda t: t in L, lambda t: t in registry),
+      ('position (.index(target))', L.index, registry.index),
+      ]
+    for name,legacy,new in rows:
+      a, b = perOp(legacy,sample), perOp(new,sample)
+      print "  %-28s list %10.2fus  registry %8.3fus  -> per page/discovery (x%s): %8.2fs vs %.4fs" % (name,a*1e6,b*1e6,n,a*n,b*n)
+    t, result = timed(targets.TargetRegistry,names)
+    print "  %-28s %8.3fs" % ('building the registry',t)
+
+
+def legacySave(db, target, values):
+  '''
+  The original Application.save: one UPDATE per band plus viewed, committed right away
+  '''
+  SQL = 'UPDATE Flags SET viewed=1 WHERE target="%s";' % target
+  for band in BANDS:
+    SQL += 'UPDATE Flags SET %s=%s WHERE target="%s";' % (band,values[band],target)
+  db.executescript(SQL)
+  db.commit()
+
+
+def benchSave(args):
+  import random
+  import grond_dataviewer as app
+  from lib import flagstate
+  from lib import writer
+  random.seed(42)
+  tmp = tempfile.mkdtemp(prefix='grond_bench_',dir=args.dir)
+  names = ['/data/grond/run%s/OB%s_1' % (i//100,i) for i in range(args.targets)]
+  #going back and forth like a reviewer, toggling a flag now and then
+  visits = [names[min(len(names)-1,max(0,i//2+random.choice((-1,0,1))))] for i in range(args.saves)]
+  def values():
+    return dict((band,random.choice((0,0,0,1,2))) for band in BANDS)
+  def report(name, latencies, total):
+    latencies = sorted(latencies)
+    print "%-28s per save: mean %7.3fms  max %7.3fms   until durable %7.3fs" % (name,sum(latencies)/len(latencies)*1000,latencies[-1]*1000,total)
+  try:
+    print "%s saves, database in %s (%s)" % (len(visits),tmp,writer.filesystemType(tmp))
+    db = freshDatabase(app,tmp,'legacy.db')
+    app.registerTargets(db,names)
+    L = []
+    start = time.time()
+    for target in visits:
+      L.append(timed(legacySave,db,target,values())[0])
+    report('executescript + commit',L,time.time()-start)
+
+    db = freshDatabase(app,tmp,'sync.db')
+    app.registerTargets(db,names)
+    L = []
+    start = time.time()
+    for target in visits:
+      state = flagstate.FlagState(target,False,values())
+      state.saved = dict((band,0) for band in BANDS)
+      L.append(timed(lambda: state.save(db) and db.commit())[0])
+    report('changed columns + commit',L,time.time()-start)
+
+    db = freshDatabase(app,tmp,'writer.db')
+    app.registerTargets(db,names)
+    db.close()
+    w = writer.FlagWriter(app.DATABASE)
+    L = []
+    start = time.time()
+    for target in visits:
+      state = flagstate.FlagState(target,False,values())
+      state.saved = dict((band,0) for band in BANDS)
+      L.append(timed(lambda: w.put(target,state.changes()))[0])
+    w.close()
+    report('write-behind (%s)' % w.journal,L,time.time()-start)
+    print "  %s" % w.stats()
+  finally:
+    shutil.rmtree(tmp)
+
+
+def makeFits(d, n, shape):
+  '''
+  Writes n synthetic GROND-like frames of the given shape into d
+  '''
+  import numpy
+  import pyfits
+  paths = []
+  for i in range(n):
+    band = BANDS[i % len(BANDS)]
+    f = os.path.join(d,'img%s_GROND_%s_OB_ana.fits' % (i,band))
+    data = numpy.random.normal(1000.0,30.0,shape).astype('float32')
+    header = pyfits.Header()
+    header['FILTER'] = band
+    pyfits.PrimaryHDU(data,header).writeto(f)
+    paths.append(f)
+  return paths
+
+
+def peakRSS():
+  import resource
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0 #MB on Linux
+
+
+def runRSS(args):
+  '''
+  Submits all images of args.dir to a render pool like Application.renderImages does,
+  either the original way (args.mode=arrays) or by path, and reports the parent's peak RSS
+  '''
+  import glob
+  import pyfits
+  from multiprocessing import Pool
+  from lib import astImages
+  images = sorted(glob.glob(os.path.join(args.dir,'*_ana.fits')))
+  pool = Pool(processes=args.workers)
+  start = time.time()
+  for n,image in enumerate(images):
+    fname = os.path.join(args.dir,'%s_%s.png' % (args.mode,n))
+    if args.mode == 'arrays':
+      fp = pyfits.open(image)
+      d = fp[0].data
+      caption = fp[0].header.get('FILTER')
+      fp.close()
+      del fp
+      pool.apply_async(astImages.saveBitmap,[fname,image,d,300,'gray_r',caption])
+    else:
+      pool.apply_async(astImages.saveBitmapFromFile,[fname,image,300,'gray_r'])
+  pool.close()
+  pool.join()
+  print "%s %.3f %.1f" % (args.mode,time.time()-start,peakRSS())
+
+
+def benchRSS(args):
+  import subprocess
+  tmp = tempfile.mkdtemp(prefix='grond_bench_')
+  try:
+    makeFits(tmp,args.images,(args.npix,args.npix))
+    print "%s frames of %sx%s float32 (%.0f MB each), %s workers" % (args.images,args.npix,args.npix,args.npix**2*4/1024.0**2,args.workers)
+    for mode in ('arrays','paths'):
+      cmd = [sys.executable,os.path.abspath(__file__),'rss-run',tmp,mode,'--workers',str(args.workers)]
+      out = subprocess.check_output(cmd).split()
+      print "  %-40s %8ss  parent peak RSS %8s MB" % ({'arrays':'pixel arrays through the pool (original)','paths':'paths, memory-mapped in the workers'}[mode],out[1],out[2])
+  finally:
+    shutil.rmtree(tmp)
+
+
+def currentRSS():
+  '''
+  Resident memory of this process in MB (Linux), or None
+  '''
+  try:
+    with open('/proc/self/status') as fp:
+      for line in fp:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1])/1024.0
+  except IOError:
+    pass
+  return None
+
+
+def viewerSession(tmp, targets, options=()):
+  '''
+  Starts the viewer on a synthetic tree of small frames with its database and thumbnail
+  cache in tmp, and waits until all thumbnails are rendered. Returns (Tk root, Application),
+  or None without a display.
+  '''
+  import numpy
+  import pyfits
+  import Tkinter as tk
+  import grond_dataviewer as viewer
+  try:
+    root = tk.Tk()
+  except tk.TclError, e:
+    print "The viewer needs a display: %s" % e
+    return None
+  data = os.path.join(tmp,'data')
+  rng = numpy.random.RandomState(0)
+  for n in range(targets):
+    for band in BANDS:
+      d = os.path.join(data,'OB%s_1' % n,band)
+      os.makedirs(d)
+      pyfits.PrimaryHDU(rng.normal(1000.0,30.0,(256,256)).astype('float32')).writeto(os.path.join(d,'GROND_%s_OB_ana.fits' % band))
+  viewer.DATABASE = os.path.join(tmp,'dataviewer.db')
+  viewer.CACHE_DIR = os.path.join(tmp,'cache')
+  os.mkdir(viewer.CACHE_DIR)
+  viewer.IMAGE_ENGINE = viewer.ENGINES['fast']
+  viewer.RENDER_PARAMS['engine'] = viewer.IMAGE_ENGINE.__name__
+  app = viewer.Application(root,viewer.argumentParser().parse_args([data]+list(options)))
+  app.scheduler.join()
+  app.drainRenders()
+  root.update()
+  return root,app
+
+
+def benchNavigation(args):
+  tmp = tempfile.mkdtemp(prefix='grond_bench_')
+  try:
+    session = viewerSession(tmp,args.targets)
+    if session is None:
+      return
+    root,app = session
+    try:
+      rss = currentRSS()
+      times = []
+      for n in range(args.navigations):
+        start = time.time()
+        app.save()
+        app.setTarget(app.targets[(n+1) % len(app.targets)])
+        app.showTarget()
+        root.update()
+        times.append(time.time()-start)
+      times.sort()
+      print "%s navigations over %s targets: median %.1f ms, 95%% %.1f ms, max %.1f ms" % (len(times),len(app.targets),times[len(times)//2]*1000,times[int(len(times)*0.95)]*1000,times[-1]*1000)
+      if rss is not None:
+        print "RSS %.1f MB before, %.1f MB after" % (rss,currentRSS())
+      if app.prefetcher is not None:
+        print "Prefetch: %s" % app.prefetcher.stats()
+    finally:
+      app.shutdown()
+      root.destroy()
+  finally:
+    shutil.rmtree(tmp)
+
+
+def benchEngines(args):
+  from lib import astImages
+  tmp = tempfile.mkdtemp(prefix='grond_bench_')
+  try:
+    images = makeFits(tmp,args.images,(args.npix,args.npix))
+    print "%s frames of %sx%s, %spx thumbnails" % (args.images,args.npix,args.npix,args.size)
+    for name,engine in (('saveBitmapFromFile (matplotlib)',astImages.saveBitmapFromFile),('saveBitmapFast',astImages.saveBitmapFast)):
+      engine(os.path.join(tmp,'warmup.png'),images[0],args.size,'gray_r') #imports, fonts, colormap LUT
+      t, result = timed(lambda: [engine(os.path.join(tmp,'%s.png' % n),img,args.size,'gray_r') for n,img in enumerate(images)])
+      print "  %-32s %8.1f ms/image" % (name,t/len(images)*1000)
+  finally:
+    shutil.rmtree(tmp)
+
+
+def syntheticFrame(npix, seed):
+  '''
+  Sky background, read noise, some stars and a few bad (NaN) pixels
+  '''
+  import numpy
+  rng = numpy.random.RandomState(seed)
+  data = rng.normal(1000.0,30.0,(npix,npix)).astype('float32')
+  y, x = numpy.mgrid[0:31,0:31]
+  for i in range(npix//20):
+    cy, cx = rng.randint(0,npix-31,2)
+    data[cy:cy+31,cx:cx+31] += rng.exponential(2000.0)*numpy.exp(-((x-15)**2+(y-15)**2)/(2*2.0**2))
+  data[rng.randint(0,npix,npix//10),rng.randint(0,npix,npix//10)] = numpy.nan
+  return data
+
+
+def borderedFrames(npix):
+  '''
+  Noise frames with a blank (zero), NaN or structured (gradient) border at the bottom
+  (the first rows of the array), as left by coadding; the cut levels must not depend on where the samples are taken
+  '''
+  import numpy
+  frames = []
+  for i,(name,rows) in enumerate([('blank',40),('NaN',npix//10),('gradient',npix//10)]):
+    data = numpy.random.RandomState(i).normal(1000.0,30.0,(npix,npix)).astype('float32')
+    if name == 'blank':
+      data[:rows] = 0.0
+    elif name == 'NaN':
+      data[:rows] = numpy.nan
+    else:
+      data[:rows] += numpy.linspace(0.0,5000.0,rows).astype('float32')[:,numpy.newaxis]
+    frames.append(('%s bottom %s' % (name,rows),data))
+  return frames
+
+
+def writeCompressed(path, data, header):
+  '''
+  Writes data as plain, fpack'd (RICE, one tile per row) and gzipped FITS;
+  returns {format: path}
+  '''
+  import gzip
+  import pyfits
+  paths = {'plain': path, 'fz': path+'.fz', 'gz': path+'.gz'}
+  pyfits.PrimaryHDU(data,header=header).writeto(paths['plain'])
+  hdu = pyfits.CompImageHDU(data,compression_type='RICE_1')
+  for key in header:
+    hdu.header[key] = header[key]
+  pyfits.HDUList([pyfits.PrimaryHDU(),hdu]).writeto(paths['fz'])
+  with open(paths['plain'],'rb') as fin:
+    fout = gzip.open(paths['gz'],'wb')
+    shutil.copyfileobj(fin,fout)
+    fout.close()
+  for p in paths.values():
+    fd = os.open(p,os.O_RDONLY)
+    os.fsync(fd) #dirty pages can't be dropped from the page cache
+    os.close(fd)
+  return paths
+
+
+def dropFromPageCache(path):
+  '''
+  So that the next read of path goes to the disk and shows up in read_bytes
+  '''
+  import ctypes
+  import ctypes.util
+  libc = ctypes.CDLL(ctypes.util.find_library('c'))
+  POSIX_FADV_DONTNEED = 4
+  fd = os.open(path,os.O_RDONLY)
+  try:
+    libc.posix_fadvise(fd,ctypes.c_longlong(0),ctypes.c_longlong(0),POSIX_FADV_DONTNEED)
+  finally:
+    os.close(fd)
+
+
+def readBytes():
+  '''
+  Bytes this process read from disk so far (Linux), or None
+  '''
+  try:
+    with open('/proc/self/io') as fp:
+      for line in fp:
+        if line.startswith('read_bytes:'):
+          return int(line.split()[1])
+  except IOError:
+    pass
+  return None
+
+
+def benchCompressed(args):
+  import pyfits
+  from lib import astImages
+  tmp = tempfile.mkdtemp(prefix='grond_bench_')
+  try:
+    frames = []
+    for i in range(args.images):
+      header = pyfits.Header()
+      header['FILTER'] = BANDS[i % len(BANDS)]
+      frames.append(writeCompressed(os.path.join(tmp,'img%s_GROND_%s_OB_ana.fits' % (i,header['FILTER'])),syntheticFrame(args.npix,i),header))
+    print "%s frames of %sx%s, %spx thumbnails; page cache dropped before every render" % (args.images,args.npix,args.npix,args.size)
+    engine = astImages.saveBitmapFast
+    engine(os.path.join(tmp,'warmup.png'),frames[0]['plain'],args.size,'gray_r')
+    plain = None
+    for fmt in ('plain','fz','gz'):
+      elapsed = 0.0
+      read = 0
+      size = 0
+      for n,paths in enumerate(frames):
+        size += os.path.getsize(paths[fmt])
+        dropFromPageCache(paths[fmt])
+        before = readBytes()
+        t, result = timed(engine,os.path.join(tmp,'%s_%s.png' % (fmt,n)),paths[fmt],args.size,'gray_r')
+        elapsed += t
+        read += readBytes()-before if before is not None else 0
+      n = float(len(frames))
+      if plain is None:
+        plain = elapsed
+      print "  %-6s %6.1f MB/file %8.1f ms/image (x%.2f) %8.2f MB read/image" % (fmt,size/n/1024**2,elapsed/n*1000,elapsed/plain,read/n/1024**2)
+    if readBytes() is None:
+      print "(no /proc/self/io here, bytes read are not measured)"
+  finally:
+    shutil.rmtree(tmp)
+
+
+def benchCutLevels(args):
+  import numpy
+  import pyfits
+  from lib import astImages
+  if args.fits:
+    frames = [(os.path.basename(f),pyfits.getdata(f)) for f in args.fits]
+  else:
+    frames = [('synthetic %s' % i,syntheticFrame(args.npix,i)) for i in range(args.images)]
+    frames += borderedFrames(args.npix)
+  tfull = tfast = 0
+  worst = 0
+  for name,data in frames:
+    t1, full = timed(astImages.zscale,data)
+    t2, sampled = timed(astImages.cutLevels,data,args.samples)
+    t3, small = timed(astImages.reduceForDisplay,data,args.size)
+    d = astImages.compareCutLevels(data,args.samples)
+    worst = max(worst,abs(d['lowDiff']),abs(d['highDiff']))
+    tfull += t1
+    tfast += t2+t3
+    print "  %-20s full (%9.2f, %9.2f)  sampled (%9.2f, %9.2f)  diff %+6.2f%% %+6.2f%% of range  binned to %s" % (name,full[0],full[1],sampled[0],sampled[1],100*d['lowDiff'],100*d['highDiff'],'x'.join(map(str,small.shape)))
+  print "zscale on full frames: %.1f ms/image; sampled cut levels + binning: %.1f ms/image; worst difference %.2f%% of range: %s" % (tfull/len(frames)*1000,tfast/len(frames)*1000,100*worst,'OK' if worst <= args.tolerance else 'FAILED')
+
+
+def benchZscale(args):
+  import numpy
+  import pyfits
+  from lib import astImages
+  try:
+    from stsci.numdisplay import zscale as stsciZscale
+  except ImportError:
+    print "stsci.numdisplay is not installed, nothing to compare against"
+    return
+  if args.fits:
+    frames = [(os.path.basename(f),pyfits.getdata(f)) for f in args.fits]
+  else:
+    #frames with bad pixels are left out: stsci.numdisplay does not handle NaNs
+    frames = [('synthetic %s' % i,numpy.nan_to_num(syntheticFrame(args.npix,i))) for i in range(args.images)]
+    frames += [('flat %s' % i,numpy.random.RandomState(i).normal(10.0,1.0,(args.npix,args.npix))) for i in range(2)]
+  tnew = told = 0
+  worst = 0
+  for name,data in frames:
+    t1, old = timed(lambda: [stsciZscale.zscale(data) for i in range(args.repeat)])
+    t2, new = timed(lambda: [astImages.zscale(data) for i in range(args.repeat)])
+    old, new = old[0], new[0]
+    diff = max(abs(new[0]-old[0]),abs(new[1]-old[1]))/(float(old[1]-old[0]) or 1.0)
+    worst = max(worst,diff)
+    told += t1
+    tnew += t2
+    print "  %-16s stsci (%10.3f, %10.3f)  built-in (%10.3f, %10.3f)  diff %.1e of range" % (name,old[0],old[1],new[0],new[1],diff)
+  n = len(frames)*args.repeat
+  print "stsci.numdisplay %.2f ms, built-in %.2f ms per call; worst difference %.1e of range: %s" % (told/n*1000,tnew/n*1000,worst,'OK' if worst <= args.tolerance else 'FAILED')
+
+
+def benchDiscovery(args):
+  tmp = None
+  root = args.path
+  if root is None:
+    tmp = tempfile.mkdtemp(prefix='grond_bench_')
+    root = tmp
+    n = makeTree(root,args.depth,args.fanout,args.obs)
+    print "Synthetic tree: depth=%s fanout=%s, %s OBs in %s" % (args.depth,args.fanout,n,root)
+  if args.latency:
+    addLatency(args.latency/1000.0)
+    print "Emulating %sms per directory listing" % args.latency
+  try:
+    t, reference = timed(legacyWalk,root)
+    print "%-24s %8.3fs  %s targets" % ('os.walk (original)',t,len(reference))
+    for workers in args.workers:
+      t, targets = timed(discovery.discoverTargets,scanIndexDB(),root,FITS_REGEX,rescan=True,workers=workers)
+      same = 'same order' if targets == reference else 'DIFFERENT RESULT'
+      print "%-24s %8.3fs  %s targets, %s" % ('%s worker(s)' % workers,t,len(targets),same)
+  finally:
+    if tmp is not None:
+      shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  sub = parser.add_subparsers()
+
+  p = sub.add_parser('discovery',help="cold directory walk: os.walk vs. the (parallel) discovery engine")
+  p.add_argument('--path',default=None,help="walk an existing tree instead of a synthetic one")
+  p.add_argument('--depth',type=int,default=4)
+  p.add_argument('--fanout',type=int,default=4)
+  p.add_argument('--obs',type=int,default=4,help="OB directories per leaf directory")
+  p.add_argument('--workers',type=int,nargs='+',default=[1,4,8,16])
+  p.add_argument('--latency',type=float,default=0,help="emulated ms per directory listing")
+  p.set_defaults(func=benchDiscovery)
+
+  p = sub.add_parser('registration',help="registering new targets in the database")
+  p.add_argument('--targets',type=int,default=50000)
+  p.add_argument('--legacy',type=int,default=2000,help="targets registered the original way (it is slow)")
+  p.set_defaults(func=benchRegistration)
+
+  p = sub.add_parser('registry',help="target list lookups: plain list vs. TargetRegistry")
+  p.add_argument('--sizes',type=int,nargs='+',default=[10000,100000])
+  p.add_argument('--sample',type=int,default=1000,help="lookups timed per size")
+  p.set_defaults(func=benchRegistry)
+
+  p = sub.add_parser('save',help="latency of saving a target: legacy vs. changed columns vs. write-behind")
+  p.add_argument('--targets',type=int,default=1000)
+  p.add_argument('--saves',type=int,default=500)
+  p.add_argument('--dir',default=None,help="put the databases here, e.g. on the network file system used in production")
+  p.set_defaults(func=benchSave)
+
+  p = sub.add_parser('navigation',help="viewer: latency of going to the next target, and memory growth (needs a display)")
+  p.add_argument('--targets',type=int,default=20)
+  p.add_argument('--navigations',type=int,default=1000)
+  p.set_defaults(func=benchNavigation)
+
+  p = sub.add_parser('engines',help="per-image render time of the thumbnail engines")
+  p.add_argument('--images',type=int,default=14)
+  p.add_argument('--npix',type=int,default=2048)
+  p.add_argument('--size',type=int,default=300)
+  p.set_defaults(func=benchEngines)
+
+  p = sub.add_parser('cutlevels',help="subsampled vs. full-resolution zscale: time and difference of the limits")
+  p.add_argument('fits',nargs='*',help="FITS files to use instead of synthetic frames")
+  p.add_argument('--images',type=int,default=7)
+  p.add_argument('--npix',type=int,default=2048)
+  p.add_argument('--size',type=int,default=300)
+  p.add_argument('--samples',type=int,default=100000)
+  p.add_argument('--tolerance',type=float,default=0.5,help="largest accepted difference, as a fraction of the range; zscale's own sampling noise reaches about a third of it on star fields (default: %(default)s)")
+  p.set_defaults(func=benchCutLevels)
+
+  p = sub.add_parser('compressed',help="rendering plain vs. fpack'd vs. gzipped frames: time and bytes read")
+  p.add_argument('--images',type=int,default=7)
+  p.add_argument('--npix',type=int,default=2048)
+  p.add_argument('--size',type=int,default=300)
+  p.set_defaults(func=benchCompressed)
+
+  p = sub.add_parser('zscale',help="built-in zscale vs. stsci.numdisplay: limits and time")
+  p.add_argument('fits',nargs='*',help="FITS files to use instead of synthetic frames")
+  p.add_argument('--images',type=int,default=5)
+  p.add_argument('--npix',type=int,default=2048)
+  p.add_argument('--repeat',type=int,default=5)
+  p.add_argument('--tolerance',type=float,default=1e-6,help="largest accepted difference, as a fraction of the range")
+  p.set_defaults(func=benchZscale)
+
+  p = sub.add_parser('rss',help="parent peak RSS: pixel arrays vs. paths handed to the render pool")
+  p.add_argument('--images',type=int,default=28)
+  p.add_argument('--npix',type=int,default=2048)
+  p.add_argument('--workers',type=int,default=4)
+  p.set_defaults(func=benchRSS)
+
+  p = sub.add_parser('rss-run') #one measurement of 'rss', run in a fresh process
+  p.add_argument('dir')
+  p.add_argument('mode',choices=['arrays','paths'])
+  p.add_argument('--workers',type=int,default=4)
+  p.set_defaults(func=runRSS)
+
+  args = parser.parse_args()
+  args.func(args)
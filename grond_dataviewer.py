@@ -1,19 +1,29 @@
 #!/usr/bin/env python
 import Tkinter as tk       
-from PIL import Image, ImageTk
 import os
 import sys
 import sqlite3
-import pyfits
-from multiprocessing import Pool
-import uuid
-import re
 import argparse
 import time
+import threading
+import Queue
+import zlib
+import signal
 
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
 sys.path.insert(0,BASEDIR)
 from lib import astImages
+from lib import discovery
+from lib import targets
+from lib import watch
+from lib import thumbcache
+from lib import scheduler
+from lib import tiles
+from lib import photocache
+from lib import targetlist
+from lib import flagstate
+from lib import writer
+from lib import prefetch
 
 DEBUG = False
 
@@ -22,10 +32,28 @@ WIKI_PAGE = 'grond_dataQA'
 
 DATABASE = os.path.join(BASEDIR,'dataviewer.db')
 CACHE_DIR = os.path.join(BASEDIR,'cache')
-FITS_REGEX = 'GROND_._OB_ana.fits'
-IMAGE_ENGINE = astImages.saveBitmap
+FITS_REGEX = 'GROND_._OB_ana\.fits(\.fz|\.gz)?$' #plain, fpack'd or gzipped
+ENGINES = {
+  'matplotlib': astImages.saveBitmapFromFile,
+  'fast':       astImages.saveBitmapFast, #no matplotlib figure, several times faster
+}
+IMAGE_ENGINE = ENGINES['matplotlib']
+THUMBNAIL_SIZE = 300
+COLORMAP = 'gray_r'
+#everything that changes the look of a thumbnail; part of its cache key
+RENDER_PARAMS = {'engine': IMAGE_ENGINE.__name__, 'size': THUMBNAIL_SIZE, 'cmap': COLORMAP, 'stretch': 'zscale-sampled', 'binning': 'mean'}
+MOSAIC_COLUMNS = 3 #like the thumbnails on the page
 PLACEHOLDER_PNG = os.path.join(BASEDIR,'images/placeholder.png')
 BANDS = 'grizJHK'
+SCAN_WORKERS = 8 #concurrent directory listings; pays off on NFS/Lustre
+DISCOVERY_POLL_MS = 200 #how often the GUI picks up targets found in streaming mode
+DISCOVERY_BATCH_SECONDS = 1.0 #streaming mode registers new targets at most this often
+WATCH_POLL_MS = 1000 #how often the GUI picks up images reported by the watcher
+RENDER_POLL_MS = 250 #how often the GUI picks up finished renders
+RENDER_MEMORY_FACTOR = 3 #peak memory of a render job per byte of FITS file
+PRERENDER_DB_TIMEOUT = 300 #seconds to wait for the database while other nodes write to it
+TILES_DIR = os.path.join(CACHE_DIR,'tiles')
+PYRAMID_PARAMS = {'tile_size': tiles.TILE_SIZE, 'cmap': COLORMAP, 'stretch': 'zscale-sampled'}
 
 FLAGS = {
   0:  ('Guiding problems', 'flag_guiding'),
@@ -33,12 +61,8 @@ FLAGS = {
   2:  ('Readout noise problems', 'flag_roNoise'),
   3:  ('Unknown major problems', 'flag_unknownErr'),
 }
-
-
-def decodeIntFlag(val):
-  #FLAGSET_LENGTH=64;x=67;z=[x & (2**n) for n in range(FLAGSET_LENGTH)]
-  setFlags = [val & (2**n) for n in range(len(FLAGS))]
-  return setFlags
+RAPID_KEYS = '''Rapid review: g r i z j h k select a band, 1-%s toggle its flags, Return/Right save and continue,
+Left previous target, c all clean (clear the flags and continue), u next unviewed target''' % len(FLAGS)
 
 
 def initdb():
@@ -53,7 +77,128 @@ def initdb():
   db.executescript(SQL)
   db.commit()
   db.close()
-  
+
+
+def upgradedb(db):
+  '''
+  Creates the tables added after the original schema, so existing databases keep working
+  '''
+  SQL = '''
+        CREATE TABLE IF NOT EXISTS ScanIndex (path TEXT PRIMARY KEY, mtime REAL, scanned REAL, pattern TEXT, subdirs TEXT, files TEXT);
+        CREATE UNIQUE INDEX IF NOT EXISTS FlagsTarget ON Flags (target);
+        CREATE UNIQUE INDEX IF NOT EXISTS MissingImagesTarget ON MissingImages (target);
+        CREATE TABLE IF NOT EXISTS Thumbnails (fits TEXT PRIMARY KEY, key TEXT, png TEXT, created REAL);
+        CREATE TABLE IF NOT EXISTS ReviewTimes (id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT, started REAL, seconds REAL, display_ms REAL, waited INTEGER, rapid INTEGER);
+        '''
+  SQL = SQL.strip()
+  if DEBUG:
+    print "upgradedb: SQL:\n %s" % SQL
+  db.executescript(SQL)
+  db.commit()
+
+
+class CountingConnection(sqlite3.Connection):
+  '''
+  Counts the statements it runs, for the per-page query counts of the DEBUG output
+  '''
+  queries = 0
+
+  def execute(self, *args):
+    self.queries += 1
+    return sqlite3.Connection.execute(self,*args)
+
+  def executemany(self, *args):
+    self.queries += 1
+    return sqlite3.Connection.executemany(self,*args)
+
+  def executescript(self, *args):
+    self.queries += 1
+    return sqlite3.Connection.executescript(self,*args)
+
+
+def connectdb(timeout=5.0):
+  if not os.path.isfile(DATABASE):
+    initdb()
+  db = sqlite3.connect(DATABASE,timeout=timeout,factory=CountingConnection)
+  upgradedb(db)
+  return db
+
+
+def registerTargets(db, targets):
+  '''
+  Adds targets to Flags and MissingImages in a single transaction.
+  Targets that are already registered are left untouched (unique index on target).
+  Returns the number of newly registered targets.
+  '''
+  SQL = 'INSERT OR IGNORE INTO %s (target, %s) VALUES (?, %s)'
+  flagsSQL = SQL % ('Flags','viewed,'+','.join(BANDS),','.join(["0" for i in range(len(BANDS)+1)]))
+  missingSQL = SQL % ('MissingImages',','.join(BANDS),','.join(["0" for i in range(len(BANDS))]))
+  if DEBUG:
+    print "registerTargets: %s targets with SQL:\n%s\n%s" % (len(targets),flagsSQL,missingSQL)
+  rows = [(t,) for t in targets]
+  with db:
+    n = db.executemany(flagsSQL,rows).rowcount
+    db.executemany(missingSQL,rows)
+  return n
+
+
+def renderCost(image):
+  '''
+  Estimated peak memory of rendering image in a worker, in bytes: the frame as float32,
+  plus the binned copy and temporaries. Compressed images are sized uncompressed, as
+  the worker may have to decompress them as a whole.
+  '''
+  try:
+    return RENDER_MEMORY_FACTOR*astImages.imageBytes(image)
+  except Exception:
+    return 0
+
+
+def renderJobs(thumbnails, registry, fitsimages, mosaic=False):
+  '''
+  Looks up the thumbnails of fitsimages and groups the ones that have to be (re-)rendered
+  by target: all bands of a target, and its mosaic if requested, are made by one task.
+  The thumbnails to render are recorded in the cache.
+  Returns ({FITS path or target: cached PNG}, [(target, task args, cost)]).
+  '''
+  cached = {}
+  todo = {}
+  order = []
+  for image in fitsimages:
+    target = discovery.targetFromImage(image,FITS_REGEX)
+    if target not in todo:
+      todo[target] = []
+      order.append(target)
+    png,key = thumbnails.lookup(image)
+    if png is not None:
+      cached[image] = png
+    elif key is not None:
+      todo[target].append((image,key))
+  thumbnails.record([row for target in order for row in todo[target]])
+  jobs = []
+  mosaics = []
+  for target in order:
+    mosaicName,panels = None,None
+    if mosaic:
+      images = [registry.images(target)[band] for band in BANDS]
+      png,key = thumbnails.lookupMosaic(target,images)
+      if png is not None:
+        cached[target] = png
+      else:
+        mosaics.append((target,key))
+        mosaicName = thumbnails.pngPath(key)
+        panels = [thumbnails.png(image) if image else None for image in images]
+    if todo[target] or mosaicName:
+      #the worker reads the files itself; pickling the pixels through the pool pipe
+      #would cost a copy per image and pile up in the task queue
+      args = ([(thumbnails.pngPath(key),image) for image,key in todo[target]],THUMBNAIL_SIZE,COLORMAP,IMAGE_ENGINE,mosaicName,panels,MOSAIC_COLUMNS)
+      #the bands are rendered one after the other
+      cost = max([renderCost(image) for image,key in todo[target]] or [0])
+      jobs.append((target,args,cost))
+  thumbnails.record(mosaics)
+  return cached,jobs
+
+
 class AutoScrollbar(tk.Scrollbar):
     # a scrollbar that hides itself if it's not needed.  only
     # works if you use the grid geometry manager.
@@ -80,10 +225,13 @@ class Application():
   '''
 
   def __init__(self, root, args, master=None):
+    self.root = root
     self.args = args
     self.connectToDB()
-    self.initTargets()
-    self.initImages()
+    self.flagstates = {}
+    self.pageQueries = 0
+    self.review = None
+    self.band = BANDS[0]
 
     #http://effbot.org/zone/tkinter-autoscrollbar.htm
     vscrollbar = AutoScrollbar(root)
@@ -97,6 +245,7 @@ class Application():
                     width=500,
                     height=500)
     canvas.grid(row=0, column=0, sticky=tk.N+tk.S+tk.E+tk.W)
+    self.canvas = canvas
 
     vscrollbar.config(command=canvas.yview)
     hscrollbar.config(command=canvas.xview)
@@ -111,80 +260,207 @@ class Application():
     self.frame = tk.Frame(canvas)
     self.frame.rowconfigure(1, weight=1)
     self.frame.columnconfigure(1, weight=1)
-    self.createWidgets()
-
     canvas.create_window(0, 0, anchor=tk.NW, window=self.frame)
 
-    self.frame.update_idletasks()
+    if self.args.stream:
+      self.startDiscovery()
+    else:
+      self.initTargets()
+      self.initImages()
+      self.showFirstPage()
+      if self.args.watch:
+        self.startWatch()
 
-    canvas.config(scrollregion=canvas.bbox("all"))
+  def showFirstPage(self):
+    self.createWidgets()
+    self.frame.update_idletasks()
+    self.canvas.config(scrollregion=self.canvas.bbox("all"))
 
   def initTargets(self):
-    self.targets = []
-    SQL = 'SELECT target FROM Flags'
-    #if self.args.resume: #Not yet implemented
-    #  SQL+= ' WHERE viewed==0'
-    previous_targets = [i[0] for i in self.db.execute(SQL).fetchall()]
     if DEBUG:
       print "Walking directory structure to find GROND images. This may take a moment!"
-    for path, dirs, files in os.walk(sys.argv[1]):
-      for f in files:
-        if re.search(FITS_REGEX,f):
-          img = os.path.join(os.path.abspath(path),f)
-          target = img[:re.search(FITS_REGEX,img).start()-2]
-          if target not in self.targets:
-            self.targets.append(target)
-            if target not in previous_targets:
-              SQL = '''
-                    INSERT INTO Flags (target, viewed, %s) VALUES (%s, 0, %s); 
-                    '''
-              SQL = SQL.strip()
-              SQL = SQL % (','.join([i for i in BANDS]), '"%s"' % target, ','.join(["0" for i in range(len(BANDS))]) )
-              SQL+= '''
-                    INSERT INTO MissingImages (target, %s) VALUES (%s, %s) 
-                    '''     
-              SQL = SQL.strip()
-              SQL = SQL % (','.join([i for i in BANDS]), '"%s"' % target, ','.join(["0" for i in range(len(BANDS))]) )         
-              if DEBUG:
-                print "initTarget with SQL:\n%s" % SQL
-              self.db.executescript(SQL)
-              self.db.commit()
+    found = discovery.discoverTargets(self.db,self.args.PATH[0],FITS_REGEX,rescan=self.args.rescan,workers=self.args.scan_workers)
+    n = registerTargets(self.db,found)
+    self.targets = targets.TargetRegistry(found)
+    self.targets.loadState(self.db)
+    if DEBUG:
+      print "Found %s targets, %s of them new" % (len(self.targets),n)
     self.current_target = self.targets[0]
 
+  def startDiscovery(self):
+    '''
+    Streaming mode: targets are discovered by a background thread and handed to the Tk
+    loop through a queue; the first page is shown as soon as the first target is found.
+    '''
+    self.targets = targets.TargetRegistry()
+    self.targets.loadState(self.db)
+    self.current_target = None
+    self.initImages()
+    self.searching = tk.Label(self.frame,text="Searching %s for GROND images..." % self.args.PATH[0])
+    self.searching.grid(column=0,row=0)
+    self.discovered = Queue.Queue()
+    t = threading.Thread(target=self.runDiscovery)
+    t.daemon = True
+    t.start()
+    self.root.after(DISCOVERY_POLL_MS,self.pollDiscovery)
+
+  def runDiscovery(self):
+    '''
+    Runs in the discovery thread, which needs its own database connection.
+    Targets are registered in batches before they are queued for the GUI.
+    '''
+    db = sqlite3.connect(DATABASE)
+    batch = []
+    last = 0
+    try:
+      for target in discovery.iterTargets(db,self.args.PATH[0],FITS_REGEX,rescan=self.args.rescan,workers=self.args.scan_workers):
+        batch.append(target)
+        if time.time()-last > DISCOVERY_BATCH_SECONDS:
+          registerTargets(db,batch)
+          [self.discovered.put(t) for t in batch]
+          batch = []
+          last = time.time()
+      registerTargets(db,batch)
+      [self.discovered.put(t) for t in batch]
+    finally:
+      self.discovered.put(None)
+      db.close()
+
+  def pollDiscovery(self):
+    '''
+    Moves newly discovered targets from the discovery thread into the GUI
+    '''
+    new = []
+    finished = False
+    while True:
+      try:
+        target = self.discovered.get_nowait()
+      except Queue.Empty:
+        break
+      if target is None:
+        finished = True
+        break
+      new.append(target)
+    if new:
+      self.addTargets(new)
+    if not finished:
+      self.root.after(DISCOVERY_POLL_MS,self.pollDiscovery)
+    else:
+      if not self.targets:
+        self.searching.config(text="No GROND images found in %s" % self.args.PATH[0])
+      if DEBUG:
+        print "Discovery finished: %s targets" % len(self.targets)
+      if self.args.watch:
+        self.startWatch()
+
+  def addTargets(self,found):
+    '''
+    Appends targets to the review list, queues their images and updates the page
+    '''
+    new = self.targets.extend(found)
+    self.queueImages(new)
+    if self.current_target is None:
+      self.setTarget(self.targets[0])
+      self.searching.destroy()
+      self.showFirstPage()
+      return
+    self.appendToList(new)
+
+  def appendToList(self,new):
+    self.targetlist.append(new)
+    self.counter.config(text=self.counterText())
+
+  def startWatch(self):
+    '''
+    Watch mode: images written below PATH from now on are added without a restart
+    '''
+    self.watched = Queue.Queue()
+    self.watcher = watch.Watcher(DATABASE,self.args.PATH[0],FITS_REGEX,self.watched.put,workers=self.args.scan_workers)
+    self.watcher.start()
+    self.root.after(WATCH_POLL_MS,self.pollWatch)
+
+  def pollWatch(self):
+    images = []
+    while True:
+      try:
+        images.extend(self.watched.get_nowait())
+      except Queue.Empty:
+        break
+    if images:
+      self.addImages(images)
+    self.root.after(WATCH_POLL_MS,self.pollWatch)
+
+  def addImages(self,images):
+    '''
+    Registers the targets of newly written images and renders only these images
+    (all available bands for targets seen for the first time)
+    '''
+    found = []
+    for img in images:
+      target = discovery.targetFromImage(img,FITS_REGEX)
+      self.targets.invalidate(target)
+      found.append(target)
+    new = self.targets.extend(found)
+    if DEBUG:
+      print "Watcher (%s): %s new images, %s new targets" % (self.watcher.mode,len(images),len(new))
+    registerTargets(self.db,new)
+    self.queueImages(new)
+    new = set(new)
+    updated = set()
+    SQL = 'UPDATE MissingImages SET %s=0 WHERE target=?'
+    for img in images:
+      target = discovery.targetFromImage(img,FITS_REGEX)
+      band = os.path.basename(os.path.dirname(img))
+      if target in new or img in updated or band not in BANDS:
+        continue
+      updated.add(img)
+      self.db.execute(SQL % band,(target,))
+    self.db.commit()
+    self.renderImages(sorted(updated))
+    if self.current_target is None:
+      if self.targets:
+        self.setTarget(self.targets[0])
+        self.searching.destroy()
+        self.showFirstPage()
+    elif new:
+      self.appendToList([t for t in self.targets if t in new])
+
   def initImages(self):
     '''
-    Finds all GROND_._OB_ana.fits files in the CL specified directory
-    Gives these images to the (async) process that creates the PNGs 
+    Starts the (async) process pool that creates the PNGs and gives it all known targets
     '''
-    pool = Pool(processes=16) #more than OK for sauron
+    executor = scheduler.RenderExecutor(workers=self.args.render_workers,memoryBudget=self.args.render_memory*1024**2 if self.args.render_memory else None)
+    if DEBUG:
+      print "Render pool: %s workers, %s jobs and %.0f MB in flight at most" % (executor.workers,executor.maxInFlight,executor.memoryBudget/1024.0**2)
+    #every job brings its own callback
+    self.scheduler = scheduler.RenderScheduler(executor,lambda result: None,self.targets.index,lookahead=self.args.lookahead)
+    if self.current_target is not None:
+      self.scheduler.setCurrent(self.current_target)
     self.cache={}
+    self.prefetcher = prefetch.Prefetcher(self.args.prefetch_memory*1024**2) if self.args.prefetch else None
+    self.photos = photocache.PhotoCache(self.args.photo_cache*1024**2,self.prefetcher,PLACEHOLDER_PNG)
+    self.pyramids = set()
+    self.pyramidErrors = {} #pyramidDir: traceback of the failed build
+    self.thumbnails = thumbcache.ThumbnailCache(self.db,CACHE_DIR,RENDER_PARAMS)
+    self.rendered = Queue.Queue()
+    self.root.after(RENDER_POLL_MS,self.pollRenders)
+    self.queueImages(self.targets)
+
+  def queueImages(self,targetlist):
+    '''
+    Finds the GROND_._OB_ana.fits files of the given targets
+    Gives these images to the (async) process that creates the PNGs 
+    '''
     fitsimages = []
     missingimages = []
-    for target in self.targets:
+    for target in targetlist:
+      images = self.targets.images(target)
       for band in BANDS:
-        img = os.path.join(target,'%s/GROND_%s_OB_ana.fits' % (band,band))
-        if os.path.isfile(img):
-          fitsimages.append(img)
+        if images[band]:
+          fitsimages.append(images[band])
         else:
           missingimages.append( (target,band) )
-    for image in fitsimages:
-      if IMAGE_ENGINE==astImages.saveBitmap:
-        fp = pyfits.open(image)
-        d = fp[0].data    
-        caption = fp[0].header.get('FILTER')
-        fp.close()
-        del fp
-        fname = os.path.join(CACHE_DIR,'%s.png' % uuid.uuid4())
-        args = [fname,image,d,300,'gray_r',caption]
-      #if IMAGE_ENGINE==lib.ds9: #Not yet implemented
-      #  args = []
-      if DEBUG:
-        print "Running asnyc job with args=%s" % args
-      loadvalue = float(fitsimages.index(image))/len(fitsimages)*100.0
-      if not round(loadvalue) % 10:
-        print "Loading: %0.1f%%" % (loadvalue)
-      pool.apply_async(IMAGE_ENGINE,args,callback=self.updateCache)
-      #pool.apply(IMAGE_ENGINE,args)
+    self.renderImages(fitsimages)
     
     SQL = ''
     for target,band in missingimages:
@@ -195,30 +471,96 @@ class Application():
       SQL = SQL % (band,target)
     self.db.executescript(SQL)
 
+  def renderImages(self,fitsimages):
+    '''
+    Gives the images without an up-to-date cached thumbnail to the (async) process
+    that creates the PNGs
+    '''
+    cached,jobs = renderJobs(self.thumbnails,self.targets,fitsimages,self.args.mosaic)
+    self.cache.update(cached)
+    if DEBUG:
+      print "Thumbnail cache: %s of %s images cached, %s targets to render" % (len(set(cached) & set(fitsimages)),len(fitsimages),len(jobs))
+    for n,(target,args,cost) in enumerate(jobs):
+      if DEBUG:
+        print "Running asnyc job with args=%s" % (args,)
+      loadvalue = float(n)/len(jobs)*100.0
+      if not round(loadvalue) % 10:
+        print "Loading: %0.1f%%" % (loadvalue)
+      self.scheduler.submit(target,astImages.saveBitmapsFromFiles,args,cost=cost,callback=lambda result,target=target: self.rendered.put((target,result)))
+
+  def pollRenders(self):
+    self.drainRenders()
+    self.root.after(RENDER_POLL_MS,self.pollRenders)
 
-  def updateCache(self,*args):
+  def drainRenders(self):
     '''
-    Callback function that is called whenever an async task completes.
-    Updates the internal cache with {FITS_path:PNG_path}
+    Takes the finished renders from the pool's result thread, updates the thumbnails of
+    the current target that just finished and the render status
     '''
-    image = args[0][0]
-    fname = args[0][1]
-    self.cache[image]=fname
+    targets = set()
+    while True:
+      try:
+        target,result = self.rendered.get_nowait()
+      except Queue.Empty:
+        break
+      self.updateCache(result,target)
+      if target == self.current_target and hasattr(self,'imlabels'):
+        if result['mosaic'] is not None:
+          self.showImages()
+        else:
+          images = self.targets.images(target)
+          done = set(image for image,fname in result['bitmaps'])
+          self.showImages([band for band in BANDS if images[band] in done])
+      targets.add(target)
+    if not hasattr(self,'status'):
+      return
+    if targets:
+      self.prefetchNext()
+    self.status.config(text=self.statusText())
+
+  def statusText(self):
+    m = self.scheduler.metrics()
+    text = "Renders: %s done, %s remaining" % (m['completed'],m['queued']+m['inflight'])
+    if m['failed']:
+      text += ", %s failed" % m['failed']
+    return text
+
+
+  def updateCache(self,result,target):
+    '''
+    Called on the Tk thread for every finished render (see drainRenders).
+    Updates the internal cache with {FITS_path:PNG_path} and {target:mosaic PNG_path}
+    '''
+    for image,fname in result['bitmaps']:
+      self.replaceInCache(image,fname)
+    for image,error in result['failed']:
+      print "Rendering failed for %s:\n%s" % (image,error)
+    if result['mosaic'] is not None:
+      self.replaceInCache(target,result['mosaic'])
+
+  def replaceInCache(self,key,fname):
+    '''
+    Shows fname instead of the previous thumbnail of key, which is deleted now
+    '''
+    old = self.cache.get(key)
+    if old is not None and old != fname:
+      self.photos.invalidate(old)
+    self.cache[key]=fname
+    self.thumbnails.written(fname)
 
   def connectToDB(self):
-    if not os.path.isfile(DATABASE):
-      initdb()
-    self.db = sqlite3.connect(DATABASE)
+    self.db = connectdb()
+    self.writer = writer.FlagWriter(DATABASE)
 
-  def getImagesFromCache(self):
+  def getImagesFromCache(self,target):
     '''
     Looks into the internal cache for PNGs. If not there, returns a placeholder image
     '''
     L = []
+    images = self.targets.images(target)
     for band in BANDS:
-      ct = self.current_target
-      ci = os.path.join(ct,'%s/GROND_%s_OB_ana.fits' % (band,band))
-      if ci in self.cache.keys():
+      ci = images[band]
+      if ci in self.cache:
         L.append(self.cache[ci])
       else:
         L.append(PLACEHOLDER_PNG)
@@ -233,86 +575,272 @@ class Application():
     print "row:", grid_info["row"], "column:", grid_info["column"] 
 
   def refresh(self):
-    self.clear()
-    self.createWidgets()
-
-  def clear(self):
-    [i.grid_forget() for i in self.imlabels]
-    [b.grid_forget() for b in self.buttons]
-    [c.grid_forget() for c in self.checkboxes]
-    [l.grid_forget() for l in self.labels]
-    [f.grid_forget() for f in self.frames]
+    self.showTarget()
 
   def save(self):
     '''
-    Saves current info into the database
+    Saves current info into the database: marks the target viewed and writes the flag
+    columns that changed. The writer thread commits them; this does not wait for the disk.
     '''
-    
-    SQL = '''  UPDATE Flags SET viewed=1 WHERE target=="%s"; ''' % self.current_target
-    SQL = SQL.strip()
-    for band in BANDS:
-      value = 0
-      for k,v in self.flags[band].iteritems():
-        value += v.get()*2**k
-      SQL+='UPDATE Flags SET %s=%s WHERE target=="%s";' % (band,value,self.current_target)
+    state = self.flagState(self.current_target)
+    changes = state.changes()
     if DEBUG:
-      print "save with SQL:\n%s" % SQL
-    self.db.executescript(SQL)
-    self.db.commit()
+      print "save: %s" % changes
+    if changes:
+      self.writer.put(self.current_target,changes)
+      state.markSaved(changes)
+    self.targets.setViewed(self.current_target)
+    self.targets.setFlagged(self.current_target,state.isFlagged())
+
+  def flagState(self,target):
+    '''
+    The decoded flags of target; read from the database once
+    '''
+    if target not in self.flagstates:
+      self.flagstates[target] = flagstate.FlagState.load(self.db,target)
+    return self.flagstates[target]
+
+  def flagToggled(self,band,flagIndex):
+    self.flagState(self.current_target).set(band,flagIndex,self.flags[band][flagIndex].get())
       
 
+  def prefetchNext(self):
+    '''
+    Has the thumbnails of the next --prefetch targets in the (filtered) target list decoded
+    in the background
+    '''
+    if self.prefetcher is None:
+      return
+    pngs = []
+    target = self.current_target
+    for n in range(self.args.prefetch):
+      target = self.targetlist.nextTarget(target)
+      if target is None:
+        break
+      mosaic = self.cache.get(target) if self.args.mosaic else None
+      pngs.extend([mosaic] if mosaic is not None else self.getImagesFromCache(target))
+    self.prefetcher.want([png for png in pngs if png not in self.photos])
+
+  def shutdown(self):
+    '''
+    Cancels all pending renders, commits the pending saves and stops the background
+    threads; safe to call twice
+    '''
+    self.scheduler.shutdown(cancel=True)
+    if getattr(self,'watcher',None) is not None:
+      self.watcher.stop()
+    if getattr(self,'prefetcher',None) is not None:
+      self.prefetcher.close()
+    self.finishReview()
+    self.writer.close()
+    if DEBUG:
+      print "Saves: %s" % self.writer.stats()
+
   def quit(self):
     self.save()
-    if DEBUG:
-      print "Cleanup: Removing all PNGs in %s" % CACHE_DIR
+    self.shutdown() #the wiki upload below reads the flags just committed
     #super(Application,self).quit() #tk.Frame is old-style class, super() won't work!
     tk.Frame.quit(self.frame)
     if self.args.user:
       uploadToWiki(self.args,self.db)
 
-  def jump_to(self,lb):
-    self.save()
-    selection=lb.curselection()
-    target = lb.get(selection[0])
+  def setTarget(self,target):
+    '''
+    Makes target the current one; its images, and those of the next targets, are rendered first
+    '''
     self.current_target = target
-    self.clear()
-    self.createWidgets()
+    self.scheduler.setCurrent(target)
+    if DEBUG:
+      print "Render queue: %s" % self.scheduler.metrics()
+
+  def zoom(self,band):
+    '''
+    Opens a zoomable full-resolution view of a band of the current target. Its tile
+    pyramid is built by the render pool the first time.
+    '''
+    image = self.targets.images(self.current_target)[band]
+    if image is None:
+      return
+    try:
+      pyramidDir = os.path.join(TILES_DIR,thumbcache.thumbnailKey(image,PYRAMID_PARAMS))
+    except OSError:
+      return
+    if tiles.loadInfo(pyramidDir) is None and pyramidDir not in self.pyramids:
+      self.pyramids.add(pyramidDir)
+      self.pyramidErrors.pop(pyramidDir,None)
+      self.scheduler.submit(self.current_target,tiles.buildPyramid,(image,pyramidDir,COLORMAP),cost=renderCost(image),callback=lambda result: None,
+                            errback=lambda error: self.pyramidFailed(pyramidDir,error))
+    tiles.ZoomView(self.root,pyramidDir,"%s: %s" % (self.current_target,band),failed=lambda: self.pyramidErrors.get(pyramidDir))
+
+  def pyramidFailed(self,pyramidDir,error):
+    '''
+    Called from the pool's result thread (a dict assignment and set.discard are atomic);
+    the open ZoomView shows the error, and zooming again retries the build
+    '''
+    self.pyramidErrors[pyramidDir] = error
+    self.pyramids.discard(pyramidDir)
+
+  def zoomMosaic(self,event):
+    '''
+    Zooms into the band of the mosaic panel that was clicked
+    '''
+    label = event.widget
+    x = event.x-(label.winfo_width()-label.image.width())//2
+    y = event.y-(label.winfo_height()-label.image.height())//2
+    n = (y//THUMBNAIL_SIZE)*MOSAIC_COLUMNS+x//THUMBNAIL_SIZE
+    if 0 <= x < label.image.width() and 0 <= n < len(BANDS):
+      self.zoom(BANDS[n])
+
+  def jump_to(self,target):
+    self.save()
+    self.setTarget(target)
+    self.showTarget()
+
+  def previous(self):
+    target = self.targetlist.previousTarget(self.current_target)
+    if target is not None:
+      self.jump_to(target)
+
+  def nextUnviewed(self):
+    '''
+    Saves and goes on to the next unviewed target in the (filtered) target list
+    '''
+    target = self.targetlist.nextTarget(self.current_target)
+    while target is not None and self.targets.isViewed(target):
+      target = self.targetlist.nextTarget(target)
+    if target is None:
+      print "No unviewed targets after %s" % self.current_target
+      return
+    self.jump_to(target)
+
+  def allClean(self):
+    '''
+    Clears all flags of the current target, saves and continues
+    '''
+    state = self.flagState(self.current_target)
+    for band in BANDS:
+      for flagIndex in FLAGS:
+        state.set(band,flagIndex,False)
+        self.flags[band][flagIndex].set(0)
+    self.next()
+
+  def selectBand(self,band):
+    self.band = band
+    for l in self.bandlabels.values():
+      l.config(relief=tk.FLAT)
+    self.bandlabels[band].config(relief=tk.SOLID)
+
+  def toggleFlag(self,flagIndex):
+    var = self.flags[self.band][flagIndex]
+    var.set(1-var.get())
+    self.flagToggled(self.band,flagIndex)
+
+  def bindKeys(self):
+    '''
+    Rapid review mode: the whole review can be done from the keyboard, see RAPID_KEYS
+    '''
+    self.root.bind('<Key>',self.keyPressed)
+    self.selectBand(self.band)
+
+  def keyPressed(self,event):
+    if isinstance(event.widget,tk.Entry):
+      return #typing in the target list search
+    actions = {
+      'Return': self.next,
+      'KP_Enter': self.next,
+      'Right': self.next,
+      'Left': self.previous,
+      'c': self.allClean,
+      'u': self.nextUnviewed,
+      }
+    for band in BANDS:
+      actions[band.lower()] = lambda band=band: self.selectBand(band)
+    for flagIndex in FLAGS:
+      actions[str(flagIndex+1)] = lambda flagIndex=flagIndex: self.toggleFlag(flagIndex)
+    key = event.char.lower() if event.char and event.char.strip() else event.keysym
+    if key in actions:
+      actions[key]()
+      return 'break'
+
+  def startReview(self):
+    '''
+    Starts timing the current target, unless it is already being timed (refresh)
+    '''
+    if self.review is not None and self.review['target'] == self.current_target:
+      return
+    self.finishReview()
+    self.review = {'target': self.current_target, 'started': time.time(), 'display_ms': None, 'waited': 0}
+
+  def finishReview(self):
+    '''
+    Records the time spent on the target and how long its images took to show (NULL if
+    they never all did) in ReviewTimes
+    '''
+    review,self.review = self.review,None
+    if review is None:
+      return
+    self.writer.insert('ReviewTimes',{
+      'target': review['target'],
+      'started': review['started'],
+      'seconds': time.time()-review['started'],
+      'display_ms': review['display_ms'],
+      'waited': review['waited'],
+      'rapid': int(self.args.rapid),
+      })
+
+  def imagesShown(self):
+    '''
+    Called whenever images of the current target were put on the page; the display
+    latency is taken once all of them are shown and drawn
+    '''
+    review = self.review
+    if review is None or review['display_ms'] is not None:
+      return
+    images = self.targets.images(self.current_target)
+    if (self.args.mosaic and self.current_target in self.cache) or all(i is None or i in self.cache for i in images.values()):
+      self.root.after_idle(self.displayed,review)
+    else:
+      review['waited'] = 1
+
+  def displayed(self,review):
+    if review['display_ms'] is None:
+      review['display_ms'] = (time.time()-review['started'])*1000
+      if DEBUG:
+        print "Images of %s shown after %.1f ms" % (review['target'],review['display_ms'])
 
   def next(self):
+    '''
+    Saves and goes on to the next target in the (filtered) target list
+    '''
     self.save()
-    try:
-      self.current_target = self.targets[self.targets.index(self.current_target)+1]
-    except IndexError:
+    target = self.targetlist.nextTarget(self.current_target)
+    if target is None:
       print "\n---> Done.\n"
       self.quit()   
-    self.clear()
-    self.createWidgets()
-
+      return
+    self.setTarget(target)
+    self.showTarget()
 
-  def getFlagVal(self,band,flagIndex):
-    SQL = '''
-          SELECT %s FROM Flags WHERE target="%s"
-          '''
-    SQL=SQL.strip()
-    SQL = SQL % (band,self.current_target)
-    if DEBUG:
-      print "Querying for set flags with SQL:\n%s" % SQL
-    intFlag = self.db.execute(SQL).fetchall()[0][0]
-    L = decodeIntFlag(intFlag)
-    if not L[flagIndex]:
-      return "0"
-    return "1" #TK expects string booleans
 
+  def counterText(self):
+    return "%s (%s/%s)" % (self.current_target,self.targets.index(self.current_target)+1,len(self.targets))
 
   def createWidgets(self):
+    '''
+    Builds the page once; showTarget() fills it in for the current target
+    '''
     self.imlabels = []
     col,row = 0,0
     colspan = len(FLAGS)*2
     rowspan = colspan
-    for image in self.getImagesFromCache():
-      photo = ImageTk.PhotoImage(Image.open(image))
-      imlabel = tk.Label(self.frame,image=photo)
-      imlabel.image = photo # keep a reference!
+    #a single image decode for all bands; shown instead of the band images when available
+    self.mosaiclabel = tk.Label(self.frame)
+    self.mosaiclabel.bind('<Button-1>',self.zoomMosaic)
+    self.mosaiclabel.grid(column=0,row=0,columnspan=MOSAIC_COLUMNS*colspan,rowspan=3*rowspan,sticky=tk.W+tk.E+tk.S+tk.N)
+    self.mosaiclabel.grid_remove()
+    for band in BANDS:
+      imlabel = tk.Label(self.frame)
+      imlabel.bind('<Button-1>',lambda event,band=band: self.zoom(band))
       imlabel.grid(column=col,row=row,columnspan=colspan,rowspan=rowspan,sticky=tk.W+tk.E+tk.S+tk.N)
       col += 1*colspan
       if col > 2*colspan:
@@ -330,16 +858,17 @@ class Application():
     colspan = len(FLAGS)
     rowspan = 1
     self.flags = {}
+    self.bandlabels = {}
     for band in BANDS:
       self.flags[band] = {}
-      l = tk.Label(self.frame,text=band)
+      l = tk.Label(self.frame,text=band,borderwidth=1)
       l.grid(column=col,row=row)
       self.labels.append(l)
+      self.bandlabels[band] = l
       for flagIndex,(flagTxt,flagDBname) in FLAGS.iteritems():
         row+=1*rowspan
         self.flags[band][flagIndex] = tk.IntVar()
-        self.flags[band][flagIndex].set(self.getFlagVal(band,flagIndex))
-        c = tk.Checkbutton(self.frame,text=flagTxt,variable=self.flags[band][flagIndex])
+        c = tk.Checkbutton(self.frame,text=flagTxt,variable=self.flags[band][flagIndex],command=lambda band=band,flagIndex=flagIndex: self.flagToggled(band,flagIndex))
         c.grid(column=col,row=row,columnspan=colspan,rowspan=rowspan,sticky=tk.W)
         self.checkboxes.append(c)
       col+=1*colspan
@@ -358,42 +887,33 @@ class Application():
     b.grid(column=0,row=100)
     self.buttons.append(b)
 
-    text = "%s (%s/%s)" % (self.current_target,self.targets.index(self.current_target)+1,len(self.targets))
-    l = tk.Label(self.frame,text=text)
+    l = tk.Label(self.frame)
     l.grid(column=50,row=100)
     self.labels.append(l)
+    self.counter = l
 
-    SQL = 'SELECT viewed FROM Flags WHERE target=="%s"' % self.current_target
-    result = self.db.execute(SQL).fetchall()[0][0]
-    if result:
-      text = "This target has been viewed at least once before"
-      l = tk.Label(self.frame,text=text,fg="blue")
-      l.grid(column=1,row=100,columnspan=5,sticky=tk.W)
+    text = "This target has been viewed at least once before"
+    l = tk.Label(self.frame,text=text,fg="blue")
+    l.grid(column=1,row=100,columnspan=5,sticky=tk.W)
+    l.grid_remove()
+    self.labels.append(l)
+    self.viewedlabel = l
+
+    l = tk.Label(self.frame,text=self.statusText(),anchor=tk.W)
+    l.grid(column=0,row=101,columnspan=101,sticky=tk.W+tk.E)
+    self.labels.append(l)
+    self.status = l
+
+    if self.args.rapid:
+      l = tk.Label(self.frame,text=RAPID_KEYS,justify=tk.LEFT,anchor=tk.W)
+      l.grid(column=0,row=102,columnspan=101,sticky=tk.W+tk.E)
       self.labels.append(l)
+      self.bindKeys()
 
-    f = tk.Frame(self.frame,borderwidth=5, relief="sunken")  
+    f = targetlist.TargetList(self.frame,self.targets,self.jump_to,borderwidth=5,relief="sunken")
     f.grid(column=100,row=1,sticky=tk.W,rowspan=100)
     self.frames.append(f)
-    sb = tk.Scrollbar(f)
-    sb.pack(side=tk.RIGHT, fill=tk.Y)
-    lb = tk.Listbox(f,height=25)
-    lb.pack(side=tk.LEFT)
-
-    for t in self.targets:
-      lb.insert(tk.END, t)
-      SQL = '''
-            SELECT viewed FROM Flags where target="%s"
-            '''
-      SQL = SQL.strip()
-      SQL = SQL % t
-      if self.db.execute(SQL).fetchall()[0][0]:
-        lb.itemconfig(self.targets.index(t), bg='blue', fg='white')
-    lb.itemconfig(self.targets.index(self.current_target), bg='green', fg='black')
-    lb.config(yscrollcommand=sb.set)
-    sb.config(command=lb.yview)
-  
-    b = tk.Button(f,text="Go",command=lambda: self.jump_to(lb))
-    b.pack()
+    self.targetlist = f
 
     if DEBUG:
       print "Images:"
@@ -404,6 +924,126 @@ class Application():
       [self.printPosition(f) for f in self.frames]
       print "Checkboxes:"
       [self.printPosition(c) for c in self.checkboxes]
+    self.showTarget()
+
+  def showImages(self,bands=BANDS):
+    '''
+    Shows the mosaic of the current target, or the thumbnails of the given bands
+    '''
+    mosaic = self.cache.get(self.current_target) if self.args.mosaic else None
+    if mosaic is not None:
+      photo = self.photos.get(mosaic)
+      self.mosaiclabel.config(image=photo)
+      self.mosaiclabel.image = photo # keep a reference!
+      self.mosaiclabel.grid()
+      [imlabel.grid_remove() for imlabel in self.imlabels]
+      self.imagesShown()
+      return
+    for band,imlabel,image in zip(BANDS,self.imlabels,self.getImagesFromCache(self.current_target)):
+      if band not in bands:
+        continue
+      photo = self.photos.get(image)
+      imlabel.config(image=photo)
+      imlabel.image = photo
+      imlabel.grid()
+    self.mosaiclabel.grid_remove()
+    self.imagesShown()
+
+  def showTarget(self):
+    '''
+    Shows the current target on the page: swaps the images, sets the flag checkboxes and
+    moves the highlight in the target list
+    '''
+    self.startReview()
+    self.showImages()
+
+    state = self.flagState(self.current_target)
+    for band in BANDS:
+      for flagIndex in FLAGS:
+        self.flags[band][flagIndex].set(int(state.get(band,flagIndex)))
+
+    self.counter.config(text=self.counterText())
+    if self.targets.isViewed(self.current_target):
+      self.viewedlabel.grid()
+    else:
+      self.viewedlabel.grid_remove()
+
+    self.targetlist.setCurrent(self.current_target)
+    self.prefetchNext()
+
+    if DEBUG:
+      print "Photo cache: %s" % self.photos.stats()
+      if self.prefetcher is not None:
+        print "Prefetch: %s" % self.prefetcher.stats()
+      print "Saves: %s" % self.writer.stats()
+      print "Database queries since the last page: %s" % (self.db.queries-self.pageQueries)
+    self.pageQueries = self.db.queries
+
+
+def parseShard(s):
+  '''
+  argparse type of --shard: "i/N" means the i-th (0-based) of N shards
+  '''
+  try:
+    i,n = [int(v) for v in s.split('/')]
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected i/N, e.g. 0/4")
+  if not 0 <= i < n:
+    raise argparse.ArgumentTypeError("shard index must be in 0..N-1")
+  return i,n
+
+
+def inShard(target, shard):
+  '''
+  Stable across nodes and runs (unlike hash()), so the shards never overlap
+  '''
+  i,n = shard
+  return (zlib.crc32(target) & 0xffffffff) % n == i
+
+
+def prerender(args):
+  '''
+  Headless: renders the missing thumbnails of all targets below PATH (or of one shard of
+  them) into the thumbnail cache, so that the GUI starts with a warm cache.
+  Several nodes sharing CACHE_DIR and the database can each take one --shard.
+  '''
+  started = time.time()
+  db = connectdb(timeout=PRERENDER_DB_TIMEOUT)
+  found = discovery.discoverTargets(db,args.PATH[0],FITS_REGEX,rescan=args.rescan,workers=args.scan_workers)
+  registerTargets(db,found)
+  if args.shard:
+    found = [t for t in found if inShard(t,args.shard)]
+  registry = targets.TargetRegistry(found)
+  thumbnails = thumbcache.ThumbnailCache(db,CACHE_DIR,RENDER_PARAMS)
+  fitsimages = [image for target in registry for band,image in sorted(registry.images(target).items()) if image]
+  cached,jobs = renderJobs(thumbnails,registry,fitsimages,args.mosaic)
+  db.close()
+  print "Prerender: %s targets%s, %s images cached, %s targets to render" % (len(registry),' in shard %s/%s' % args.shard if args.shard else '',len(set(cached) & set(fitsimages)),len(jobs))
+
+  progress = {'targets': 0, 'images': 0, 'failed': 0, 'next': 0.0}
+  def rendered(result):
+    for image,png in result['bitmaps']:
+      thumbnails.written(png)
+    if result['mosaic'] is not None:
+      thumbnails.written(result['mosaic'])
+    progress['targets'] += 1
+    progress['images'] += len(result['bitmaps'])
+    progress['failed'] += len(result['failed'])
+    for image,error in result['failed']:
+      print "Rendering failed for %s:\n%s" % (image,error)
+    if progress['targets'] >= progress['next']*len(jobs):
+      print "Rendered %s/%s targets" % (progress['targets'],len(jobs))
+      progress['next'] += 0.1
+  executor = scheduler.RenderExecutor(workers=args.render_workers,memoryBudget=args.render_memory*1024**2 if args.render_memory else None)
+  renders = scheduler.RenderScheduler(executor,rendered,registry.index)
+  try:
+    for target,jobargs,cost in jobs:
+      renders.submit(target,astImages.saveBitmapsFromFiles,jobargs,cost=cost)
+    renders.join()
+  finally:
+    renders.shutdown(cancel=True)
+  elapsed = time.time()-started
+  print "Prerender finished in %.1f s: %s images rendered, %s failed (%.1f images/s)" % (elapsed,progress['images'],progress['failed']+renders.metrics()['failed'],progress['images']/elapsed)
 
 
 def uploadToWiki(args,db):
@@ -456,16 +1096,47 @@ def uploadToWiki(args,db):
 
 
 
-if __name__ == "__main__":
+def argumentParser():
   parser = argparse.ArgumentParser()
   parser.add_argument('PATH',nargs=1)
   parser.add_argument('-u','--user',nargs=1,required=False,dest="user")
   parser.add_argument('-p','--password',nargs=1,required=False,dest="passwd")
+  parser.add_argument('--rescan',action='store_true',default=False,help="ignore the scan index and walk the whole PATH again")
+  parser.add_argument('--stream',action='store_true',default=False,help="open the GUI right away and add targets while PATH is being walked")
+  parser.add_argument('--watch',action='store_true',default=False,help="keep watching PATH for new images (inotify, or polling without pyinotify)")
+  parser.add_argument('--scan-workers',type=int,default=SCAN_WORKERS,dest="scan_workers",help="number of threads walking PATH (default: %(default)s)")
+  parser.add_argument('--render-workers',type=int,default=None,dest="render_workers",help="render processes (default: number of cores - 1)")
+  parser.add_argument('--render-memory',type=int,default=None,dest="render_memory",help="MB of memory the renders in flight may use (default: a quarter of the RAM)")
+  parser.add_argument('--lookahead',type=int,default=scheduler.LOOKAHEAD,help="targets after the current one that are rendered with priority (default: %(default)s)")
+  parser.add_argument('--prerender',action='store_true',default=False,help="render the missing thumbnails without opening the GUI, e.g. on a cluster node")
+  parser.add_argument('--shard',type=parseShard,default=None,help="with --prerender: only render the targets of shard i/N (0 <= i < N)")
+  parser.add_argument('--photo-cache',type=int,default=photocache.MEMORY_MB,dest="photo_cache",help="MB of decoded thumbnails kept in memory (default: %(default)s)")
+  parser.add_argument('--prefetch',type=int,default=prefetch.TARGETS,help="targets after the current one whose thumbnails are decoded in the background, 0 to disable (default: %(default)s)")
+  parser.add_argument('--prefetch-memory',type=int,default=prefetch.MEMORY_MB,dest="prefetch_memory",help="MB of prefetched thumbnails (default: %(default)s)")
+  parser.add_argument('--rapid',action='store_true',default=False,help="rapid review: keyboard shortcuts for the flags and the navigation")
+  parser.add_argument('--mosaic',action='store_true',default=False,help="also render one image of all bands per target and show that instead of seven")
+  parser.add_argument('--engine',choices=sorted(ENGINES.keys()),default=None,help="thumbnail renderer (default: %s)" % IMAGE_ENGINE.__name__)
+  return parser
+
+
+if __name__ == "__main__":
+  parser = argumentParser()
   args = parser.parse_args()
   if DEBUG:
     print args
+  if args.engine:
+    IMAGE_ENGINE = ENGINES[args.engine]
+    RENDER_PARAMS['engine'] = IMAGE_ENGINE.__name__
+  if args.shard and not args.prerender:
+    parser.error("--shard requires --prerender")
+  if args.prerender:
+    prerender(args)
+    sys.exit(0)
+  #exit cleanly on kill/logout, so that the pending saves are committed at exit
+  for signum in (signal.SIGTERM,signal.SIGHUP):
+    signal.signal(signum,lambda signum,frame: sys.exit(128+signum))
   root = tk.Tk()
   app = Application(root,args)                       
   #root.master.title('GROND data QA')    
   root.mainloop()          
-  os.system('rm %s/*png' % CACHE_DIR)
+  app.shutdown()
@@ -21,7 +21,7 @@ REPORT_ERRORS=True
 import os
 import sys
 import math
-from stsci.numdisplay import zscale
+import struct
 import pyfits
 try:
     from scipy import ndimage
@@ -38,6 +38,121 @@ try:
 except:
     print "WARNING: astImages: failed to import matplotlib - some functions will not work."
 
+#---------------------------------------------------------------------------------------------------
+def zscaleSample(imageData, numSamples = 1000):
+    """Returns about numSamples finite pixels of an image array, taken every n-th pixel of every
+    n-th row (the IRAF/numdisplay zscale sampling, minus non-finite values). A 1d array (e.g.
+    a L{statsSample}) is sampled every n-th finite value, evenly over its whole length.
+    
+    @type imageData: numpy array
+    @param imageData: image data array
+    @type numSamples: int
+    @param numSamples: maximum number of pixels to return
+    @rtype: numpy array
+    @return: 1d float array
+    
+    """
+    imageData=numpy.asarray(imageData)
+    if imageData.ndim<2:
+        samples=numpy.asarray(imageData, dtype=numpy.float64).ravel()
+        samples=samples[numpy.isfinite(samples)]
+        if len(samples)>numSamples:
+            samples=samples[numpy.arange(numSamples)*len(samples)//numSamples]
+        return samples
+    stride=max(1, int(math.sqrt((imageData.shape[0]-1)*(imageData.shape[1]-1)/float(numSamples))))
+    samples=numpy.asarray(imageData[::stride, ::stride], dtype=numpy.float64).ravel()
+    return samples[numpy.isfinite(samples)][:numSamples]
+
+#---------------------------------------------------------------------------------------------------
+def zscale(imageData, numSamples = 1000, contrast = 0.25, maxReject = 0.5, minPixels = 5, \
+            kRej = 2.5, maxIterations = 5):
+    """Computes display cut levels with the IRAF zscale algorithm: a straight line is fitted to
+    the sorted sample of pixel values with iterative k-sigma rejection (growing every rejected
+    pixel by 1% of the sample), and its slope, divided by the contrast, sets the range
+    around the median. Replaces stsci.numdisplay.zscale and gives the same limits, with the
+    rejection done on boolean masks.
+    
+    @type imageData: numpy array
+    @param imageData: image data array
+    @type numSamples: int
+    @param numSamples: number of pixels sampled from the image (see L{zscaleSample})
+    @type contrast: float
+    @param contrast: contrast parameter; smaller values give a wider range
+    @type maxReject: float
+    @param maxReject: if more than this fraction of the sample is rejected, the full range
+    of the sample is returned
+    @type minPixels: int
+    @param minPixels: minimum number of good pixels for the fit
+    @type kRej: float
+    @param kRej: rejection threshold in units of sigma
+    @type maxIterations: int
+    @param maxIterations: maximum number of fit/reject iterations
+    @rtype: tuple
+    @return: (low, high)
+    
+    """
+    samples=numpy.sort(zscaleSample(imageData, numSamples))
+    npix=len(samples)
+    if npix==0:
+        return 0.0, 1.0
+    zmin=samples[0]
+    zmax=samples[-1]
+    center=(npix-1)//2
+    if npix%2==1:
+        median=samples[center]
+    else:
+        median=0.5*(samples[center]+samples[center+1])
+    
+    minpix=max(minPixels, int(npix*maxReject))
+    ngrow=max(1, int(npix*0.01))
+    
+    # Straight line fit to the sorted samples, x normalised to [-1, 1]
+    xscale=2.0/(npix-1) if npix>1 else 1.0
+    xnorm=numpy.arange(npix)*xscale-1.0
+    good=numpy.ones(npix, dtype=bool)
+    ngoodpix=npix
+    lastngoodpix=npix+1
+    kernel=numpy.ones(ngrow, dtype=numpy.int32)
+    slope=0.0
+    intercept=median
+    for iteration in range(maxIterations):
+        if ngoodpix>=lastngoodpix or ngoodpix<minpix:
+            break
+        x=xnorm[good]
+        y=samples[good]
+        n=float(len(x))
+        sumx=x.sum()
+        sumxx=(x*x).sum()
+        sumxy=(x*y).sum()
+        sumy=y.sum()
+        delta=n*sumxx-sumx*sumx
+        if delta==0:
+            break
+        intercept=(sumxx*sumy-sumx*sumxy)/delta
+        slope=(n*sumxy-sumx*sumy)/delta
+        
+        # k-sigma rejection of the residuals, then grow the rejected regions
+        flat=samples-(xnorm*slope+intercept)
+        residuals=flat[good]
+        lastngoodpix=len(residuals)
+        if lastngoodpix>1:
+            sigma=residuals.std(ddof=1)
+        else:
+            sigma=0.0
+        threshold=sigma*kRej
+        bad=~good | (flat<-threshold) | (flat>threshold)
+        good=numpy.convolve(bad.astype(numpy.int32), kernel, mode='same')==0
+        ngoodpix=int(good.sum())
+    
+    if ngoodpix<minpix:
+        return zmin, zmax
+    zslope=slope*xscale
+    if contrast>0:
+        zslope=zslope/contrast
+    z1=max(zmin, median-(center-1)*zslope)
+    z2=min(zmax, median+(npix-center)*zslope)
+    return z1, z2
+
 #---------------------------------------------------------------------------------------------------
 def clipImageSectionWCS(imageData, imageWCS, RADeg, decDeg, clipSizeDeg, returnWCS = True):
     """Clips a square or rectangular section from an image array at the given celestial coordinates. 
@@ -850,7 +965,8 @@ def generateContourOverlay(backgroundImageData, backgroundImageWCS, contourImage
     return {'scaledImage': scaledBack, 'contourLevels': cLevels}
     
 #---------------------------------------------------------------------------------------------------
-def saveBitmap(outputFileName, inputFileName, imageData, size, colorMapName, caption):
+BITMAP_FIGURE="astImages.saveBitmap"
+def saveBitmap(outputFileName, inputFileName, imageData, size, colorMapName, caption, scale = None):
     """Makes a bitmap image from an image array; the image format is specified by the
     filename extension. (e.g. ".jpg" =JPEG, ".png"=PNG).
     
@@ -870,16 +986,22 @@ def saveBitmap(outputFileName, inputFileName, imageData, size, colorMapName, cap
     @type colorMapName: string
     @param colorMapName: name of a standard matplotlib colormap, e.g. "hot", "cool", "gray"
     etc. (do "help(pylab.colormaps)" in the Python interpreter to see available options)
+    @type scale: tuple
+    @param scale: (low, high) cut levels; if None, zscale of imageData is used
     
     """
     import time
     start = time.time()
-    scale=zscale.zscale(imageData)
+    if scale is None:
+        scale=zscale(imageData)
     anorm = matplotlib.colors.Normalize(scale[0],scale[1])
     cut = {'image': imageData, 'norm': anorm}  
     # Make plot
     aspectR=float(cut['image'].shape[0])/float(cut['image'].shape[1])
-    fig = pyplot.figure(figsize=(10,10*aspectR))
+    # One figure per process, cleared and reused: creating a figure costs more than
+    # drawing a thumbnail into it
+    fig = pyplot.figure(BITMAP_FIGURE, figsize=(10,10*aspectR))
+    fig.clf()
 
     xPix = size
     yPix = size
@@ -901,8 +1023,12 @@ def saveBitmap(outputFileName, inputFileName, imageData, size, colorMapName, cap
     ymin,ymax = fig.gca().get_ylim()
     pyplot.text(xmin+1,ymin+35,caption,color="red",fontsize=20,fontweight=500,backgroundcolor='white')
 
-    pyplot.savefig(outputFileName,format="png",dpi=dpi)
-    pyplot.close()
+    #write under a temporary name, so that a killed worker never leaves a truncated PNG
+    #behind under the name the thumbnail cache will look for
+    partFileName=outputFileName+".part"
+    pyplot.savefig(partFileName,format="png",dpi=dpi)
+    fig.clf()
+    os.rename(partFileName,outputFileName)
     return inputFileName,outputFileName
 #    try:
 #        from PIL import Image
@@ -914,6 +1040,480 @@ def saveBitmap(outputFileName, inputFileName, imageData, size, colorMapName, cap
 #    
 #    os.remove("out_astImages.png")
 
+#---------------------------------------------------------------------------------------------------
+def saveBitmapFromFile(outputFileName, inputFileName, size, colorMapName):
+    """Makes a bitmap image from the image in a .fits file (see L{openImageHDU}), see
+    L{saveBitmap}. The file is read with L{loadForDisplay} and the FILTER header keyword is
+    used as caption. Meant for
+    worker processes, which then only need to be given file names instead of image arrays.
+    
+    @type outputFileName: string
+    @param outputFileName: filename of output bitmap image
+    @type inputFileName: string
+    @param inputFileName: filename of the input .fits image
+    @type size: int
+    @param size: size of output image in pixels
+    @type colorMapName: string
+    @param colorMapName: name of a standard matplotlib colormap, e.g. "hot", "cool", "gray"
+    @rtype: tuple
+    @return: (inputFileName, outputFileName), like L{saveBitmap}
+    
+    @note: Cut levels come from a L{statsSample} of the full frame, and the frame is binned
+    with L{reduceForDisplay} before plotting, as the thumbnail can't show more detail anyway
+    (see L{loadForDisplay}).
+    
+    """
+    caption, scale, small=loadForDisplay(inputFileName, size)
+    return saveBitmap(outputFileName, inputFileName, small, size, colorMapName, caption, scale)
+
+#---------------------------------------------------------------------------------------------------
+_colorMapLUTs={}
+def colorMapLUT(colorMapName, numColors = 256):
+    """Returns a lookup table of a matplotlib colormap as a (numColors, 3) uint8 RGB array.
+    Tables are computed once per colormap and process.
+    
+    @type colorMapName: string
+    @param colorMapName: name of a standard matplotlib colormap, e.g. "hot", "cool", "gray"
+    @type numColors: int
+    @param numColors: number of entries in the table
+    @rtype: numpy array
+    @return: uint8 array of shape (numColors, 3)
+    
+    """
+    key=(colorMapName, numColors)
+    if key not in _colorMapLUTs:
+        try:
+            colorMap=matplotlib.cm.get_cmap(colorMapName)
+        except (AssertionError, ValueError):
+            raise Exception, colorMapName+" is not a defined matplotlib colormap."
+        rgba=colorMap(numpy.linspace(0.0, 1.0, numColors))
+        _colorMapLUTs[key]=numpy.round(rgba[:, :3]*255.0).astype(numpy.uint8)
+    return _colorMapLUTs[key]
+
+#---------------------------------------------------------------------------------------------------
+def blockReduce(imageData, factor, method = "mean", rowFactor = None):
+    """Bins an image array by an integer factor along both axes, ignoring NaNs (a block that
+    is entirely NaN gives NaN). Rows and columns that do not fill a whole block are dropped.
+    
+    @type imageData: numpy array
+    @param imageData: image data array
+    @type factor: int
+    @param factor: binning factor
+    @type method: string
+    @param method: "mean" or "median"
+    @type rowFactor: int
+    @param rowFactor: binning factor along the rows (first axis), if different from factor
+    @rtype: numpy array
+    @return: binned image array (float32)
+    
+    """
+    imageData=numpy.asarray(imageData)
+    if rowFactor is None:
+        rowFactor=factor
+    if factor<2 and rowFactor<2:
+        return imageData.astype(numpy.float32)
+    factor=max(factor, 1)
+    rowFactor=max(rowFactor, 1)
+    h=(imageData.shape[0]//rowFactor)*rowFactor
+    w=(imageData.shape[1]//factor)*factor
+    blocks=imageData[:h, :w].astype(numpy.float32).reshape(h//rowFactor, rowFactor, w//factor, factor)
+    blocks=blocks.swapaxes(1, 2).reshape(h//rowFactor, w//factor, rowFactor*factor)
+    if numpy.isfinite(blocks).all():
+        if method=="median":
+            return numpy.median(blocks, axis=2)
+        return blocks.mean(axis=2)
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if method=="median":
+            return numpy.nanmedian(blocks, axis=2)
+        return numpy.nanmean(blocks, axis=2)
+
+#---------------------------------------------------------------------------------------------------
+def reduceForDisplay(imageData, size, method = "mean"):
+    """Bins an image array (see L{blockReduce}) to about twice the size at which it is going to
+    be displayed, which is enough for a smooth thumbnail. Never enlarges.
+    
+    @type imageData: numpy array
+    @param imageData: image data array
+    @type size: int
+    @param size: size of the displayed image in pixels
+    @type method: string
+    @param method: "mean" or "median"
+    @rtype: numpy array
+    @return: binned image array (float32)
+    
+    """
+    return blockReduce(imageData, max(imageData.shape)//(2*size), method)
+
+#---------------------------------------------------------------------------------------------------
+STATS_SAMPLES=100000
+def statsStride(shape, numSamples = STATS_SAMPLES):
+    """Stride along both axes of the grid used by L{statsSample}.
+    
+    """
+    return max(1, int(math.ceil(math.sqrt(shape[0]*shape[1]/float(numSamples)))))
+
+#---------------------------------------------------------------------------------------------------
+def statsSample(imageData, numSamples = STATS_SAMPLES):
+    """Returns a deterministic subsample of about numSamples finite pixels of an image array,
+    taken on a regular grid (every n-th pixel of every n-th row). For a memory-mapped array
+    only the sampled rows are read.
+    
+    @type imageData: numpy array
+    @param imageData: image data array
+    @type numSamples: int
+    @param numSamples: approximate number of pixels to return
+    @rtype: numpy array
+    @return: 1d array of the finite sampled pixels (blank borders would otherwise narrow
+    the cut levels)
+    
+    """
+    stride=statsStride(imageData.shape, numSamples)
+    sample=numpy.array(imageData[::stride, ::stride], dtype=numpy.float32).ravel()
+    return sample[numpy.isfinite(sample)]
+
+#---------------------------------------------------------------------------------------------------
+def cutLevels(imageData, numSamples = STATS_SAMPLES):
+    """zscale cut levels of an image array, computed from a L{statsSample} of it (zscale
+    takes its pixels evenly from the whole sample).
+    
+    @rtype: tuple
+    @return: (low, high)
+    
+    """
+    return zscale(statsSample(imageData, numSamples))
+
+#---------------------------------------------------------------------------------------------------
+def compareCutLevels(imageData, numSamples = STATS_SAMPLES):
+    """Compares the L{cutLevels} of an image array with zscale run on the full-resolution
+    array. The differences are given as fractions of the full-resolution range.
+    
+    @rtype: dictionary
+    @return: {'full', 'sampled', 'lowDiff', 'highDiff'}
+    
+    """
+    full=zscale(numpy.asarray(imageData))
+    sampled=cutLevels(imageData, numSamples)
+    fullRange=float(full[1]-full[0]) or 1.0
+    return {'full': full, 'sampled': sampled,
+            'lowDiff': (sampled[0]-full[0])/fullRange, 'highDiff': (sampled[1]-full[1])/fullRange}
+
+#---------------------------------------------------------------------------------------------------
+def openImageHDU(inputFileName):
+    """Opens a .fits file, which may also be gzipped (.fits.gz) or tile-compressed (fpack,
+    .fits.fz), and finds the image in it: the primary HDU of a plain file, the compressed
+    image extension of an fpack'd one. Plain files are memory-mapped; close the HDU list
+    when done.
+    
+    @type inputFileName: string
+    @param inputFileName: filename of the .fits image
+    @rtype: tuple
+    @return: (HDU list, image HDU)
+    
+    """
+    fp=pyfits.open(inputFileName, memmap=True)
+    for hdu in fp:
+        if isinstance(hdu, pyfits.CompImageHDU) or (hdu.is_image and hdu.header.get('NAXIS', 0)==2):
+            return fp, hdu
+    fp.close()
+    raise Exception, inputFileName+" contains no 2d image."
+
+#---------------------------------------------------------------------------------------------------
+def imageBytes(inputFileName):
+    """Size of the image of a .fits file once uncompressed, without decompressing it: the
+    file size of a plain file, the size recorded in the gzip trailer (ISIZE) of a gzipped
+    one, and the image dimensions and ZBITPIX of a tile-compressed one.
+    
+    @type inputFileName: string
+    @param inputFileName: filename of the .fits image
+    @rtype: int
+    @return: size in bytes
+    
+    """
+    if inputFileName.endswith('.gz'):
+        fp=open(inputFileName, 'rb')
+        try:
+            fp.seek(-4, 2)
+            return struct.unpack('<I', fp.read(4))[0]
+        finally:
+            fp.close()
+    if inputFileName.endswith('.fz'):
+        fp, hdu=openImageHDU(inputFileName)
+        try:
+            header=hdu._header
+            pixels=1
+            for n in range(1, header['ZNAXIS']+1):
+                pixels*=header['ZNAXIS%d' % n]
+            return pixels*abs(header['ZBITPIX'])//8
+        finally:
+            fp.close()
+    return os.path.getsize(inputFileName)
+
+#---------------------------------------------------------------------------------------------------
+def isRowTiled(hdu):
+    """Whether hdu is a tile-compressed 2d image whose tiles span whole rows (fpack's default),
+    so that single rows can be decompressed with L{readImageRows}.
+    
+    """
+    if not isinstance(hdu, pyfits.CompImageHDU):
+        return False
+    header=hdu._header
+    return header.get('ZNAXIS')==2 and header.get('ZTILE1', header['ZNAXIS1'])==header['ZNAXIS1']
+
+#---------------------------------------------------------------------------------------------------
+_descriptorBytes={'B': 1, 'I': 2, 'J': 4, 'K': 8, 'E': 4, 'D': 8}
+def readImageRows(hdu, rows):
+    """Reads some rows of an image. For a row-tiled compressed image (see L{isRowTiled}) only
+    the tiles holding these rows are read and decompressed: they are copied into a small
+    in-memory compressed image, which is then decompressed as a whole. When that is more
+    than half of the tiles, the whole image is decompressed instead, which is faster.
+    
+    For quantized floating point images with subtractive dithering the dither of the copied
+    tiles can't be reproduced, so they are decompressed without it: pixel values are then
+    off by up to half a quantization step, well below the noise and invisible in a thumbnail.
+    
+    @type hdu: HDU
+    @param hdu: image HDU, see L{openImageHDU}
+    @type rows: list
+    @param rows: indices of the rows to read, in increasing order
+    @rtype: numpy array
+    @return: float32 array of shape (len(rows), image width)
+    
+    """
+    rows=numpy.asarray(rows)
+    if not isRowTiled(hdu):
+        return numpy.array(hdu.data[rows], dtype=numpy.float32)
+    header=hdu._header
+    tileRows=header.get('ZTILE2', 1)
+    tiles=numpy.unique(rows//tileRows)
+    if 2*len(tiles)>header['NAXIS2']:
+        return numpy.array(hdu.data[rows], dtype=numpy.float32)
+    
+    # Table rows (one per tile) and their compressed bytes in the heap, straight from the file
+    info=hdu.fileinfo()
+    fileName=info['file'].name
+    table=numpy.memmap(fileName, dtype=hdu.columns.dtype.newbyteorder('>'), mode='r', \
+                       offset=info['datLoc'], shape=(header['NAXIS2'],))
+    raw=numpy.memmap(fileName, dtype=numpy.uint8, mode='r')
+    heapStart=info['datLoc']+header.get('THEAP', header['NAXIS1']*header['NAXIS2'])
+    subset=numpy.array(table[tiles])
+    heap=[]
+    heapSize=0
+    for column in hdu.columns:
+        format=str(column.format)
+        if 'P' not in format and 'Q' not in format:
+            continue
+        elementBytes=_descriptorBytes[format.split('(')[0][-1]]
+        descriptors=subset[column.name].astype(numpy.int64)
+        counts=descriptors[:, 0]*elementBytes
+        newOffsets=heapSize+numpy.cumsum(counts)-counts
+        index=numpy.repeat(descriptors[:, 1]-newOffsets, counts)+numpy.arange(heapSize, heapSize+counts.sum())
+        heap.append(raw[heapStart+index])
+        subset[column.name][:, 1]=newOffsets
+        heapSize+=counts.sum()
+    
+    subHeader=header.copy()
+    subHeader['NAXIS2']=len(tiles)
+    subHeader['PCOUNT']=heapSize
+    subHeader.pop('THEAP', None)
+    # only the last tile of the image can be partial, so it is the last one of the copy too
+    subHeader['ZNAXIS2']=int(numpy.minimum(tileRows, header['ZNAXIS2']-tiles*tileRows).sum())
+    if str(subHeader.get('ZQUANTIZ', '')).startswith('SUBTRACTIVE_DITHER'):
+        subHeader['ZQUANTIZ']='NO_DITHER'
+    body=subset.tostring()+numpy.concatenate(heap).tostring()
+    body+='\0'*(-len(body) % 2880)
+    import io
+    subFile=pyfits.open(io.BytesIO(pyfits.PrimaryHDU().header.tostring()+subHeader.tostring()+body))
+    try:
+        data=subFile[1].data
+    finally:
+        subFile.close()
+    
+    # Rows of the decompressed tiles, in order
+    first=numpy.searchsorted(tiles, rows//tileRows)*tileRows+rows % tileRows
+    return numpy.array(data[first], dtype=numpy.float32)
+
+#---------------------------------------------------------------------------------------------------
+def loadForDisplay(inputFileName, size, numSamples = STATS_SAMPLES):
+    """Reads what is needed to make a size x size pixel bitmap image of a .fits file: cut
+    levels from a L{statsSample} and the image binned with L{reduceForDisplay}.
+    
+    For a row-tiled compressed file (see L{isRowTiled}) only the rows on the stats grid and
+    every n-th row, n being the binning factor, are decompressed; the image is then binned
+    along the rows by taking every n-th row instead of the mean. Gzipped files have to be
+    decompressed as a whole.
+    
+    @type inputFileName: string
+    @param inputFileName: filename of the .fits image, see L{openImageHDU}
+    @type size: int
+    @param size: size of the bitmap image in pixels
+    @rtype: tuple
+    @return: (FILTER header keyword, (low, high) cut levels, binned image array)
+    
+    """
+    fp, hdu=openImageHDU(inputFileName)
+    try:
+        caption=hdu.header.get('FILTER')
+        if not isRowTiled(hdu):
+            return caption, cutLevels(hdu.data, numSamples), reduceForDisplay(hdu.data, size)
+        shape=(hdu.header['NAXIS2'], hdu.header['NAXIS1'])
+        factor=max(1, max(shape)//(2*size))
+        stride=statsStride(shape, numSamples)
+        rows=sorted(set(range(0, shape[0], stride)) | set(range(0, shape[0], factor)))
+        data=readImageRows(hdu, rows)
+    finally:
+        fp.close()
+    position=dict((row, n) for n, row in enumerate(rows))
+    sample=data[[position[row] for row in range(0, shape[0], stride)], ::stride]
+    binned=data[[position[row] for row in range(0, shape[0], factor)]]
+    return caption, cutLevels(sample, sample.size), blockReduce(binned, factor, rowFactor=1)
+
+#---------------------------------------------------------------------------------------------------
+def captionFont(fontSize):
+    """Returns a PIL font for image captions: matplotlib's default TrueType font if it can be
+    found, otherwise PIL's built-in bitmap font.
+    
+    """
+    from PIL import ImageFont
+    try:
+        from matplotlib import font_manager
+        return ImageFont.truetype(font_manager.findfont(font_manager.FontProperties()), fontSize)
+    except Exception:
+        return ImageFont.load_default()
+
+#---------------------------------------------------------------------------------------------------
+def saveBitmapFast(outputFileName, inputFileName, size, colorMapName):
+    """Makes a size x size pixel bitmap image from the image in a .fits file without
+    going through a matplotlib figure: zscale cut levels from a L{statsSample}, binning with
+    L{reduceForDisplay}, a colormap lookup table and a PIL caption (FILTER header keyword),
+    drawn in the same place as L{saveBitmap} does. Drop-in replacement for
+    L{saveBitmapFromFile}; the image format is specified by the filename extension.
+    
+    @type outputFileName: string
+    @param outputFileName: filename of output bitmap image
+    @type inputFileName: string
+    @param inputFileName: filename of the input .fits image
+    @type size: int
+    @param size: size of output image in pixels
+    @type colorMapName: string
+    @param colorMapName: name of a standard matplotlib colormap, e.g. "hot", "cool", "gray"
+    @rtype: tuple
+    @return: (inputFileName, outputFileName), like L{saveBitmap}
+    
+    """
+    try:
+        from PIL import Image
+        from PIL import ImageDraw
+    except:
+        raise Exception, "astImages.saveBitmapFast requires the Python Imaging Library to be installed."
+    
+    caption, scale, small=loadForDisplay(inputFileName, size)
+    
+    # Normalise and map through the colormap; origin is at the bottom like in saveBitmap
+    lut=colorMapLUT(colorMapName)
+    low, high=float(scale[0]), float(scale[1])
+    if high<=low:
+        high=low+1.0
+    normed=(small-low)*((len(lut)-1)/(high-low))
+    normed[~numpy.isfinite(normed)]=0
+    indices=numpy.clip(normed, 0, len(lut)-1).astype(numpy.uint8)
+    rgb=lut[indices[::-1]]
+    
+    # Fit into size x size, keeping the aspect ratio, on a white background
+    im=Image.fromarray(rgb, "RGB")
+    ratio=float(size)/max(im.size)
+    im=im.resize((max(1, int(round(im.size[0]*ratio))), max(1, int(round(im.size[1]*ratio)))), Image.BILINEAR)
+    out=Image.new("RGB", (size, size), "white")
+    out.paste(im, ((size-im.size[0])//2, (size-im.size[1])//2))
+    
+    if caption:
+        draw=ImageDraw.Draw(out)
+        font=captionFont(20)
+        textWidth, textHeight=draw.textsize(str(caption), font=font)
+        x, y=1, size-35
+        draw.rectangle([x, y, x+textWidth+4, y+textHeight+4], fill="white")
+        draw.text((x+2, y+2), str(caption), fill="red", font=font)
+    
+    partFileName=outputFileName+".part"
+    out.save(partFileName, format=os.path.splitext(outputFileName)[1][1:].upper().replace("JPG", "JPEG"))
+    os.rename(partFileName, outputFileName)
+    return inputFileName,outputFileName
+
+#---------------------------------------------------------------------------------------------------
+def saveBitmapsFromFiles(jobs, size, colorMapName, bitmapFunction = saveBitmapFast, \
+                            mosaicFileName = None, panelFileNames = None, columns = 3):
+    """Makes bitmap images of several .fits images in one call, e.g. all bands of an
+    observation, and optionally a mosaic of them (see L{saveMosaic}). Meant for worker
+    processes: one task per observation instead of one per image. An image that fails does
+    not stop the others.
+    
+    @type jobs: list
+    @param jobs: [(outputFileName, inputFileName)] of the images to make
+    @type size: int
+    @param size: size of the output images in pixels
+    @type colorMapName: string
+    @param colorMapName: name of a standard matplotlib colormap, e.g. "hot", "cool", "gray"
+    @type bitmapFunction: function
+    @param bitmapFunction: L{saveBitmapFast} or L{saveBitmapFromFile}
+    @type mosaicFileName: string
+    @param mosaicFileName: filename of the mosaic, or None for no mosaic
+    @type panelFileNames: list
+    @param panelFileNames: bitmap images for the mosaic panels, see L{saveMosaic}; they may
+    include outputs of jobs
+    @type columns: int
+    @param columns: number of panels per mosaic row
+    @rtype: dictionary
+    @return: {'bitmaps': [(inputFileName, outputFileName)] of the images made,
+    'failed': [(inputFileName, traceback)], 'mosaic': mosaicFileName or None}
+    
+    """
+    import traceback
+    bitmaps=[]
+    failed=[]
+    for outputFileName, inputFileName in jobs:
+        try:
+            bitmaps.append(bitmapFunction(outputFileName, inputFileName, size, colorMapName))
+        except Exception:
+            failed.append((inputFileName, traceback.format_exc()))
+    mosaic=None
+    if mosaicFileName is not None:
+        mosaic=saveMosaic(mosaicFileName, panelFileNames, size, columns)
+    return {'bitmaps': bitmaps, 'failed': failed, 'mosaic': mosaic}
+
+#---------------------------------------------------------------------------------------------------
+def saveMosaic(outputFileName, panelFileNames, size, columns = 3):
+    """Pastes bitmap images into a single image, row by row with the given number of columns,
+    each panel scaled to fit size x size pixels. Panels that are None or do not exist are
+    left white.
+    
+    @type outputFileName: string
+    @param outputFileName: filename of the output bitmap image
+    @type panelFileNames: list
+    @param panelFileNames: filenames of the panel images, in order
+    @type size: int
+    @param size: size of a panel in pixels
+    @type columns: int
+    @param columns: number of panels per row
+    @rtype: string
+    @return: outputFileName
+    
+    """
+    from PIL import Image
+    rows=int(math.ceil(len(panelFileNames)/float(columns)))
+    out=Image.new("RGB", (columns*size, rows*size), "white")
+    for n, panelFileName in enumerate(panelFileNames):
+        if panelFileName is None or not os.path.isfile(panelFileName):
+            continue
+        panel=Image.open(panelFileName).convert("RGB")
+        if panel.size!=(size, size):
+            panel.thumbnail((size, size), Image.BILINEAR)
+        out.paste(panel, ((n % columns)*size, (n//columns)*size))
+    partFileName=outputFileName+".part"
+    out.save(partFileName, format=os.path.splitext(outputFileName)[1][1:].upper().replace("JPG", "JPEG"))
+    os.rename(partFileName, outputFileName)
+    return outputFileName
+
 #---------------------------------------------------------------------------------------------------
 def saveContourOverlayBitmap(outputFileName, backgroundImageData, backgroundImageWCS, cutLevels, \
                                 size, colorMapName, contourImageData, contourImageWCS, \
@@ -0,0 +1,200 @@
+'''
+Target discovery for the GROND data QA viewer.
+
+Walks the reduced-data tree for GROND_?_OB_ana.fits images. Every directory listing is
+remembered in the ScanIndex table together with the directory mtime, so that a relaunch
+only lists the directories whose contents changed since the previous scan. Unchanged
+directories still cost one stat(), but no listdir() and no per-file stat().
+
+On high-latency filesystems (NFS, Lustre) the walk can be spread over a pool of threads,
+each listing one directory at a time; the results are put back into os.walk order.
+'''
+import os
+import re
+import sys
+import time
+import Queue
+from multiprocessing.pool import ThreadPool
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+#A directory modified this close to the time it was listed may have changed again within
+#the mtime resolution of the filesystem (1s on many NFS servers); such listings are never
+#trusted on the next scan.
+RACY_SECONDS = 2.0
+
+
+def splitEntries(s):
+  #'/' can't appear in a file name, so it is a safe separator
+  if not s:
+    return []
+  return s.split('/')
+
+
+def targetFromImage(img, regex):
+  '''
+  The target is the OB directory holding the per-band subdirectories,
+  i.e. <target>/<band>/GROND_<band>_OB_ana.fits
+  '''
+  return img[:re.search(regex,img).start()-2]
+
+
+def loadScanIndex(db, regex):
+  '''
+  Returns {path: (mtime, scanned, subdirs, files)} for all directories previously scanned
+  with the same file name pattern
+  '''
+  index = {}
+  SQL = 'SELECT path, mtime, scanned, subdirs, files FROM ScanIndex WHERE pattern=?'
+  for path,mtime,scanned,subdirs,files in db.execute(SQL,(regex,)):
+    index[path] = (mtime, scanned, splitEntries(subdirs), splitEntries(files))
+  return index
+
+
+def listDirectory(path, regex, index):
+  '''
+  Lists a single directory, reusing the indexed listing if the directory mtime is unchanged.
+  Returns (path, mtime, subdirs, files, changed); subdirs are the directories os.walk would
+  descend into, files are the names matching regex, both in listing order.
+  Unreadable directories are skipped, like os.walk does.
+  '''
+  try:
+    mtime = os.stat(path).st_mtime
+  except OSError:
+    return path, None, [], [], True
+  cached = index.get(path)
+  if cached is not None and cached[0] == mtime and cached[1]-mtime > RACY_SECONDS:
+    return path, mtime, cached[2], cached[3], False
+  subdirs, files = [], []
+  try:
+    if scandir is not None:
+      #d_type from readdir() saves the stat() per entry on most filesystems
+      for e in scandir(path):
+        if e.is_dir():
+          if not e.is_symlink():
+            subdirs.append(e.name)
+        elif re.search(regex,e.name):
+          files.append(e.name)
+    else:
+      for name in os.listdir(path):
+        full = os.path.join(path,name)
+        if os.path.isdir(full):
+          if not os.path.islink(full):
+            subdirs.append(name)
+        elif re.search(regex,name):
+          files.append(name)
+  except OSError:
+    return path, mtime, [], [], True
+  return path, mtime, subdirs, files, True
+
+
+def listDirectoryJob(path, regex, index):
+  '''
+  Runs listDirectory() in a pool thread. Python 2 pools have no error callback, so
+  exceptions are returned (as sys.exc_info()) instead of raised; otherwise the walk
+  would wait for the listing forever. Returns (exc_info or None, entry).
+  '''
+  try:
+    return None, listDirectory(path,regex,index)
+  except Exception:
+    return sys.exc_info(), None
+
+
+def iterDirectories(root, regex, index, workers=1):
+  '''
+  Yields listDirectory() results in the same (top-down) order as os.walk(root).
+  With workers > 1, directories are listed concurrently by a pool of that many threads;
+  every listed directory immediately queues its subdirectories, while the entries are
+  handed out in walk order as soon as they are available.
+  '''
+  root = os.path.abspath(root)
+  if workers <= 1:
+    stack = [root]
+    while stack:
+      entry = listDirectory(stack.pop(),regex,index)
+      yield entry
+      path,subdirs = entry[0],entry[2]
+      stack.extend(reversed([os.path.join(path,d) for d in subdirs]))
+    return
+
+  pool = ThreadPool(processes=workers)
+  done = Queue.Queue()
+  results = {}
+
+  def submit(path):
+    pool.apply_async(listDirectoryJob,(path,regex,index),callback=done.put)
+
+  def collect(result):
+    error,entry = result
+    if error is not None:
+      raise error[0], error[1], error[2]
+    results[entry[0]] = entry
+    for d in entry[2]:
+      submit(os.path.join(entry[0],d))
+
+  try:
+    submit(root)
+    stack = [root]
+    while stack:
+      path = stack.pop()
+      while path not in results:
+        collect(done.get())
+      #keep the pool busy with whatever else has finished in the meantime
+      while True:
+        try:
+          collect(done.get_nowait())
+        except Queue.Empty:
+          break
+      entry = results.pop(path)
+      yield entry
+      stack.extend(reversed([os.path.join(path,d) for d in entry[2]]))
+  finally:
+    pool.terminate()
+
+
+def saveScanIndex(db, root, regex, index, entries, scanned):
+  '''
+  Stores the changed listings and drops directories below root that have disappeared
+  '''
+  root = os.path.abspath(root)
+  visited = set(e[0] for e in entries)
+  gone = [(p,) for p in index if (p == root or p.startswith(root+os.sep)) and p not in visited]
+  rows = [(path, mtime, scanned, regex, '/'.join(subdirs), '/'.join(files))
+          for path,mtime,subdirs,files,changed in entries if changed and mtime is not None]
+  db.executemany('DELETE FROM ScanIndex WHERE path=?',gone)
+  db.executemany('INSERT OR REPLACE INTO ScanIndex (path, mtime, scanned, pattern, subdirs, files) VALUES (?,?,?,?,?,?)',rows)
+  db.commit()
+
+
+def iterTargets(db, root, regex, rescan=False, workers=1):
+  '''
+  Yields the targets below root as they are found, in os.walk order.
+  With rescan=True the index is ignored and every directory is listed again.
+  workers is the number of threads listing directories concurrently.
+  The scan index is updated once the walk is complete.
+  '''
+  index = loadScanIndex(db,regex)
+  scanned = time.time()
+  seen = set()
+  entries = []
+  for entry in iterDirectories(root,regex,{} if rescan else index,workers):
+    entries.append(entry)
+    path,files = entry[0],entry[3]
+    for f in files:
+      target = targetFromImage(os.path.join(path,f),regex)
+      if target not in seen:
+        seen.add(target)
+        yield target
+  saveScanIndex(db,root,regex,index,entries,scanned)
+
+
+def discoverTargets(db, root, regex, rescan=False, workers=1):
+  '''
+  Returns the list of targets below root, see iterTargets
+  '''
+  return list(iterTargets(db,root,regex,rescan,workers))
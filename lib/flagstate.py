@@ -0,0 +1,73 @@
+'''
+QA flags of a target, as stored in the Flags table.
+
+Every band column holds the flags of that band as a bit set (bit n is flag n). FlagState
+reads the whole row of a target with one query and keeps it decoded; save() only writes
+the columns that changed.
+'''
+BANDS = 'grizJHK'
+
+
+class FlagState(object):
+
+  def __init__(self, target, viewed=False, values=None):
+    '''
+    values is {band: bit set}
+    '''
+    self.target = target
+    self.viewed = viewed
+    self.values = dict((band,0) for band in BANDS)
+    self.values.update(values or {})
+    self.saved = dict(self.values)
+
+  @classmethod
+  def load(cls, db, target):
+    SQL = 'SELECT viewed, %s FROM Flags WHERE target=?' % ', '.join(BANDS)
+    row = db.execute(SQL,(target,)).fetchone()
+    if row is None:
+      return cls(target)
+    return cls(target,bool(row[0]),dict((band,v or 0) for band,v in zip(BANDS,row[1:])))
+
+  def get(self, band, flagIndex):
+    return bool(self.values[band] & 2**flagIndex)
+
+  def set(self, band, flagIndex, value):
+    if value:
+      self.values[band] |= 2**flagIndex
+    else:
+      self.values[band] &= ~2**flagIndex
+
+  def isFlagged(self):
+    return any(self.values.values())
+
+  def changes(self, viewed=True):
+    '''
+    Returns {column: value} of what has to be written to mark the target viewed
+    (if viewed) and store the flags
+    '''
+    changed = dict((band,v) for band,v in self.values.iteritems() if v != self.saved[band])
+    if viewed and not self.viewed:
+      changed['viewed'] = 1
+    return changed
+
+  def markSaved(self, changed):
+    '''
+    Call once changes() have been written
+    '''
+    self.saved.update((band,v) for band,v in changed.iteritems() if band in self.saved)
+    if changed.get('viewed'):
+      self.viewed = True
+
+  def save(self, db):
+    '''
+    Writes the changed columns (nothing if there are none) without committing.
+    Returns the number of statements run.
+    '''
+    changed = self.changes()
+    if not changed:
+      return 0
+    columns = sorted(changed)
+    SQL = 'UPDATE Flags SET %s WHERE target=?' % ', '.join('%s=?' % c for c in columns)
+    db.execute(SQL,[changed[c] for c in columns]+[self.target])
+    self.markSaved(changed)
+    return 1
@@ -0,0 +1,93 @@
+'''
+In-memory LRU cache of decoded thumbnails.
+
+Going back and forth between targets would otherwise decode the same PNGs and create the
+same Tk images on every page. Entries are keyed by PNG path and the cache is bounded by
+the memory of the decoded images (Tk keeps 4 bytes per pixel). On a miss the image is
+taken from the Prefetcher, if it decoded it already.
+
+PhotoImages may only be created and deleted by the Tk thread. invalidate() can be called
+from any thread; it only marks the entry, which get() then drops.
+'''
+import threading
+import collections
+
+from PIL import Image, ImageTk
+
+MEMORY_MB = 128
+BYTES_PER_PIXEL = 4
+
+
+class PhotoCache(object):
+
+  def __init__(self, maxBytes=MEMORY_MB*1024**2, prefetcher=None, placeholder=None):
+    '''
+    placeholder is shown for PNGs that can't be read, e.g. because a re-render replaced them
+    '''
+    self.maxBytes = maxBytes
+    self.prefetcher = prefetcher
+    self.placeholder = placeholder
+    self.photos = collections.OrderedDict() #png: (PhotoImage, bytes), least recently used first
+    self.bytes = 0
+    self.stale = set()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, png):
+    '''
+    Returns the PhotoImage of png, decoding it on a miss
+    '''
+    self.dropStale()
+    entry = self.photos.pop(png,None)
+    if entry is not None:
+      self.hits += 1
+    else:
+      self.misses += 1
+      image = self.prefetcher.take(png) if self.prefetcher is not None else None
+      try:
+        photo = ImageTk.PhotoImage(image if image is not None else Image.open(png))
+      except IOError:
+        if self.placeholder is None or png == self.placeholder:
+          raise
+        return self.get(self.placeholder)
+      entry = (photo,photo.width()*photo.height()*BYTES_PER_PIXEL)
+      self.bytes += entry[1]
+    self.photos[png] = entry
+    while self.bytes > self.maxBytes and len(self.photos) > 1:
+      self.remove(next(iter(self.photos)))
+      self.evictions += 1
+    return entry[0]
+
+  def __contains__(self, png):
+    return png in self.photos and png not in self.stale
+
+  def invalidate(self, png):
+    '''
+    Forgets png, e.g. because a re-render replaced it
+    '''
+    with self.lock:
+      self.stale.add(png)
+
+  def dropStale(self):
+    with self.lock:
+      stale,self.stale = self.stale,set()
+    for png in stale:
+      if png in self.photos:
+        self.remove(png)
+
+  def remove(self, png):
+    photo,size = self.photos.pop(png)
+    self.bytes -= size
+
+  def stats(self):
+    lookups = self.hits+self.misses
+    return {
+      'entries': len(self.photos),
+      'mb': self.bytes/1024.0**2,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'hit_rate': float(self.hits)/lookups if lookups else None,
+    }
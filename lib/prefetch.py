@@ -0,0 +1,124 @@
+'''
+Look-ahead decoding of the thumbnails of the next targets.
+
+While a target is reviewed, a background thread reads and decodes the PNGs of the next
+targets into memory (PIL images), so that showing the next page does not wait for the
+(often shared) disk. The Tk thread tells the Prefetcher what it will need next with
+want(); PhotoCache takes the decoded images from it with take(), as PhotoImages may
+only be created by the Tk thread.
+'''
+import threading
+import collections
+
+from PIL import Image
+
+TARGETS = 5
+MEMORY_MB = 64
+
+
+def imageBytes(image):
+  return image.size[0]*image.size[1]*len(image.getbands())
+
+
+def decode(png):
+  image = Image.open(png)
+  image.load()
+  return image
+
+
+class Prefetcher(object):
+
+  def __init__(self, maxBytes=MEMORY_MB*1024**2):
+    self.maxBytes = maxBytes
+    self.wanted = [] #PNGs to decode, most urgent first
+    self.images = collections.OrderedDict() #png: (PIL image, bytes), oldest first
+    self.bytes = 0
+    self.failed = set()
+    self.cond = threading.Condition()
+    self.closed = False
+    self.hits = 0
+    self.misses = 0
+    self.decoded = 0
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def want(self, pngs):
+    '''
+    Replaces the PNGs to decode; images decoded earlier that are not wanted any more
+    are dropped when memory is needed
+    '''
+    with self.cond:
+      self.wanted = list(pngs)
+      self.failed = set()
+      self.cond.notify()
+
+  def take(self, png):
+    '''
+    Returns the decoded png and forgets it, or None if it was not decoded (yet)
+    '''
+    with self.cond:
+      if png in self.wanted:
+        self.wanted.remove(png)
+      entry = self.images.pop(png,None)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.bytes -= entry[1]
+      return entry[0]
+
+  def next(self):
+    '''
+    The most urgent PNG that is not decoded yet, making room for it by dropping images
+    that are not wanted any more; None if there is nothing to do or no room
+    '''
+    for png in self.wanted:
+      if png not in self.images and png not in self.failed:
+        break
+    else:
+      return None
+    wanted = set(self.wanted)
+    for old in [old for old in self.images if old not in wanted]:
+      if self.bytes < self.maxBytes:
+        break
+      self.bytes -= self.images.pop(old)[1]
+    return png if self.bytes < self.maxBytes else None
+
+  def run(self):
+    while True:
+      with self.cond:
+        png = self.next()
+        while png is None and not self.closed:
+          self.cond.wait()
+          png = self.next()
+        if self.closed:
+          return
+      try:
+        image = decode(png)
+      except (IOError, SyntaxError):
+        with self.cond:
+          self.failed.add(png)
+        continue
+      with self.cond:
+        if png in self.wanted and png not in self.images:
+          self.images[png] = (image,imageBytes(image))
+          self.bytes += self.images[png][1]
+          self.decoded += 1
+
+  def close(self):
+    with self.cond:
+      self.closed = True
+      self.cond.notify()
+
+  def stats(self):
+    with self.cond:
+      lookups = self.hits+self.misses
+      return {
+        'entries': len(self.images),
+        'mb': self.bytes/1024.0**2,
+        'decoded': self.decoded,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': float(self.hits)/lookups if lookups else None,
+      }
@@ -0,0 +1,242 @@
+'''
+Priority scheduling of the thumbnail renders.
+
+Instead of handing every image to the process pool up front, jobs wait in a heap and
+only a limited number is in flight at any time. The current target goes first, then
+the next LOOKAHEAD targets in review order; all others follow in the order they were
+submitted (the review order, for the startup queue). Whenever the current target changes
+the heap is re-ranked, so jumping to a target renders its bands and those of the targets
+after it next.
+
+The RenderExecutor owns the process pool: it is sized from the number of cores, and
+admits a job only while the number of jobs in flight and their estimated memory use
+stay within bounds. Everything else waits in the scheduler, where it can still be
+re-ranked or cancelled.
+'''
+import os
+import time
+import heapq
+import threading
+import traceback
+import multiprocessing
+
+LOOKAHEAD = 10
+MEMORY_BUDGET_FRACTION = 0.25 #of the physical memory, for all renders in flight
+
+
+def defaultWorkers():
+  '''
+  One worker per core, leaving one core for the GUI
+  '''
+  try:
+    return max(1,multiprocessing.cpu_count()-1)
+  except NotImplementedError:
+    return 1
+
+
+def defaultMemoryBudget():
+  try:
+    return int(os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')*MEMORY_BUDGET_FRACTION)
+  except (ValueError, OSError, AttributeError):
+    return 2*1024**3
+
+
+def runJob(func, args):
+  '''
+  Runs in the pool worker. Python 2 pools have no error callback, so exceptions are
+  returned instead of raised; otherwise a failed job would never free its slot.
+  '''
+  try:
+    return None, func(*args)
+  except Exception:
+    return traceback.format_exc(), None
+
+
+class RenderExecutor(object):
+
+  def __init__(self, workers=None, maxInFlight=None, memoryBudget=None):
+    '''
+    workers defaults to defaultWorkers(), maxInFlight to twice the workers (so that a
+    worker never waits for the next job) and memoryBudget (bytes) to defaultMemoryBudget()
+    '''
+    self.workers = workers or defaultWorkers()
+    self.maxInFlight = maxInFlight or 2*self.workers
+    self.memoryBudget = memoryBudget or defaultMemoryBudget()
+    self.pool = multiprocessing.Pool(processes=self.workers)
+    self.lock = threading.Lock()
+    self.inflight = 0
+    self.inflightBytes = 0
+    self.closed = False
+
+  def admits(self, cost):
+    '''
+    Whether a job with an estimated memory use of cost bytes may start now. A single job
+    is always admitted, however large, so that the queue can't get stuck.
+    '''
+    with self.lock:
+      if self.closed or self.inflight >= self.maxInFlight:
+        return False
+      return self.inflight == 0 or self.inflightBytes+cost <= self.memoryBudget
+
+  def run(self, func, args, cost, callback):
+    '''
+    Starts func(*args) in the pool; callback gets (error, result), see runJob
+    '''
+    with self.lock:
+      self.inflight += 1
+      self.inflightBytes += cost
+    self.pool.apply_async(runJob,(func,args),callback=lambda result: self.finished(cost,result,callback))
+
+  def finished(self, cost, result, callback):
+    with self.lock:
+      self.inflight -= 1
+      self.inflightBytes -= cost
+    callback(result)
+
+  def shutdown(self, cancel=True):
+    '''
+    Stops the pool; with cancel=True the jobs in flight are abandoned, otherwise they
+    are waited for
+    '''
+    with self.lock:
+      if self.closed:
+        return
+      self.closed = True
+    if cancel:
+      self.pool.terminate()
+    else:
+      self.pool.close()
+    self.pool.join()
+
+  def state(self):
+    with self.lock:
+      return {'workers': self.workers, 'inflight': self.inflight, 'inflight_mb': self.inflightBytes/1024.0**2}
+
+
+class RenderScheduler(object):
+
+  def __init__(self, executor, callback, position, lookahead=LOOKAHEAD):
+    '''
+    callback is called with the result of every successful job, from the pool's result
+    thread. position(target) returns the position of target in the review order.
+    '''
+    self.executor = executor
+    self.callback = callback
+    self.position = position
+    self.lookahead = lookahead
+    self.lock = threading.Lock()
+    self.heap = []
+    self.seq = 0
+    self.running = {}
+    self.current = None
+    self.completed = 0
+    self.failed = 0
+    self.started = time.time()
+    self.firstImage = None
+    self.waitingSince = None
+    self.targetLatencies = []
+
+  def priority(self, target):
+    '''
+    (0, distance) for the current target and the lookahead targets after it, (1, 0) for
+    all others, which then run in submission order
+    '''
+    if self.current is not None:
+      ahead = self.position(target)-self.position(self.current)
+      if 0 <= ahead <= self.lookahead:
+        return (0,ahead)
+    return (1,0)
+
+  def submit(self, target, func, args, cost=0, callback=None, errback=None):
+    '''
+    Queues func(*args) for target; cost is the estimated memory use of the job in bytes.
+    callback replaces the scheduler's callback for this job; errback is called with the
+    traceback if the job fails (from the pool's result thread, like callback).
+    '''
+    with self.lock:
+      self.seq += 1
+      heapq.heappush(self.heap,(self.priority(target),self.seq,target,func,args,cost,callback,errback))
+    self.pump()
+
+  def setCurrent(self, target):
+    '''
+    Re-ranks the waiting jobs for a new current target
+    '''
+    with self.lock:
+      self.current = target
+      self.heap = [(self.priority(job[2]),)+job[1:] for job in self.heap]
+      heapq.heapify(self.heap)
+      if self.running.get(target) or [job for job in self.heap if job[2] == target]:
+        self.waitingSince = time.time()
+      else:
+        self.waitingSince = None
+    self.pump()
+
+  def pump(self):
+    with self.lock:
+      while self.heap and self.executor.admits(self.heap[0][5]):
+        p,seq,target,func,args,cost,callback,errback = heapq.heappop(self.heap)
+        self.running[target] = self.running.get(target,0)+1
+        self.executor.run(func,args,cost,lambda result,target=target,callback=callback,errback=errback: self.done(target,result,callback,errback))
+
+  def done(self, target, result, callback=None, errback=None):
+    error,value = result
+    with self.lock:
+      self.running[target] -= 1
+      if not self.running[target]:
+        del self.running[target]
+      now = time.time()
+      if error is None:
+        self.completed += 1
+        if self.firstImage is None:
+          self.firstImage = now-self.started
+        if target == self.current and self.waitingSince is not None:
+          self.targetLatencies.append(now-self.waitingSince)
+          self.waitingSince = None
+      else:
+        self.failed += 1
+    if error is None:
+      (callback or self.callback)(value)
+    else:
+      print "Rendering failed for %s:\n%s" % (target,error)
+      if errback is not None:
+        errback(error)
+    self.pump()
+
+  def join(self, interval=0.5):
+    '''
+    Blocks until all queued jobs have finished
+    '''
+    while True:
+      with self.lock:
+        if not self.heap and not self.running:
+          return
+      time.sleep(interval)
+
+  def shutdown(self, cancel=True):
+    '''
+    Drops all waiting jobs and shuts the executor down, see RenderExecutor.shutdown
+    '''
+    with self.lock:
+      self.heap = []
+    self.executor.shutdown(cancel)
+
+  def metrics(self):
+    '''
+    Queue depth, throughput and time-to-first-image (s): since startup, and after
+    changing to a target whose images were not rendered yet (mean and last)
+    '''
+    state = self.executor.state()
+    with self.lock:
+      L = self.targetLatencies
+      return {
+        'queued': len(self.heap),
+        'inflight': state['inflight'],
+        'inflight_mb': state['inflight_mb'],
+        'workers': state['workers'],
+        'completed': self.completed,
+        'failed': self.failed,
+        'first_image': self.firstImage,
+        'target_first_image_mean': sum(L)/len(L) if L else None,
+        'target_first_image_last': L[-1] if L else None,
+      }
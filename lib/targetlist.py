@@ -0,0 +1,159 @@
+'''
+Virtualized, filterable list of the targets.
+
+A Listbox holding every target has to be filled and coloured row by row, which takes
+seconds for tens of thousands of targets. TargetList only puts the visible rows into its
+Listbox and scrolls by replacing them. Filters (unviewed only, flagged only, substring)
+run on the in-memory TargetRegistry, without database queries.
+'''
+import bisect
+import Tkinter as tk
+
+HEIGHT = 25
+
+
+class TargetList(tk.Frame):
+
+  def __init__(self, master, registry, command, height=HEIGHT, **kw):
+    '''
+    command(target) is called for the selected target on "Go" or a double click
+    '''
+    tk.Frame.__init__(self,master,**kw)
+    self.registry = registry
+    self.command = command
+    self.height = height
+    self.current = None
+    self.items = [] #the targets passing the filter, in review order
+    self.positions = [] #and their positions in the registry
+    self.offset = 0 #of the first visible row in items
+
+    self.search = tk.StringVar()
+    self.unviewed = tk.IntVar()
+    self.flagged = tk.IntVar()
+    tk.Entry(self,textvariable=self.search).pack(side=tk.TOP,fill=tk.X)
+    self.search.trace('w',lambda *args: self.applyFilter())
+    tk.Checkbutton(self,text="Unviewed only",variable=self.unviewed,command=self.applyFilter).pack(side=tk.TOP,anchor=tk.W)
+    tk.Checkbutton(self,text="Flagged only",variable=self.flagged,command=self.applyFilter).pack(side=tk.TOP,anchor=tk.W)
+    self.count = tk.Label(self)
+    self.count.pack(side=tk.TOP,anchor=tk.W)
+
+    rows = tk.Frame(self)
+    rows.pack(side=tk.TOP)
+    self.scrollbar = tk.Scrollbar(rows,command=self.yview)
+    self.scrollbar.pack(side=tk.RIGHT,fill=tk.Y)
+    self.listbox = tk.Listbox(rows,height=height)
+    self.listbox.pack(side=tk.LEFT)
+    self.listbox.bind('<Double-Button-1>',lambda event: self.go())
+    self.listbox.bind('<Button-4>',lambda event: self.yview('scroll',-3,'units'))
+    self.listbox.bind('<Button-5>',lambda event: self.yview('scroll',3,'units'))
+    self.listbox.bind('<MouseWheel>',lambda event: self.yview('scroll',-3 if event.delta > 0 else 3,'units'))
+    tk.Button(self,text="Go",command=self.go).pack(side=tk.TOP)
+    self.applyFilter()
+
+  def filterValues(self):
+    '''
+    (unviewed, flagged, search) of the filter widgets; read once per pass, as reading a Tk
+    variable for every target is slow
+    '''
+    return self.unviewed.get(),self.flagged.get(),self.search.get()
+
+  def matches(self, target, unviewed, flagged, search):
+    if unviewed and self.registry.isViewed(target):
+      return False
+    if flagged and not self.registry.isFlagged(target):
+      return False
+    return search in target
+
+  def applyFilter(self):
+    self.items = []
+    self.positions = []
+    values = self.filterValues()
+    for n,target in enumerate(self.registry):
+      if self.matches(target,*values):
+        self.items.append(target)
+        self.positions.append(n)
+    self.see(self.current)
+    self.redraw()
+
+  def append(self, targets):
+    '''
+    Adds targets that were appended to the registry
+    '''
+    values = self.filterValues()
+    for target in targets:
+      if self.matches(target,*values):
+        self.items.append(target)
+        self.positions.append(self.registry.index(target))
+    self.redraw()
+
+  def find(self, target):
+    '''
+    Position of target in the filtered list, or None
+    '''
+    if target not in self.registry:
+      return None
+    i = bisect.bisect_left(self.positions,self.registry.index(target))
+    if i < len(self.items) and self.items[i] == target:
+      return i
+    return None
+
+  def nextTarget(self, target):
+    '''
+    The first target after target (which need not pass the filter) in the filtered list, or None
+    '''
+    i = bisect.bisect_right(self.positions,self.registry.index(target))
+    return self.items[i] if i < len(self.items) else None
+
+  def previousTarget(self, target):
+    '''
+    The last target before target (which need not pass the filter) in the filtered list, or None
+    '''
+    i = bisect.bisect_left(self.positions,self.registry.index(target))
+    return self.items[i-1] if i > 0 else None
+
+  def setCurrent(self, target):
+    self.current = target
+    self.see(target)
+    self.redraw()
+
+  def see(self, target):
+    i = self.find(target)
+    if i is not None and not self.offset <= i < self.offset+self.height:
+      self.offset = i-self.height//2
+    self.offset = max(0,min(self.offset,len(self.items)-self.height))
+
+  def yview(self, *args):
+    '''
+    Scrollbar command
+    '''
+    if args[0] == 'moveto':
+      self.offset = int(float(args[1])*len(self.items))
+    elif args[0] == 'scroll':
+      self.offset += int(args[1])*(self.height if args[2] == 'pages' else 1)
+    self.offset = max(0,min(self.offset,len(self.items)-self.height))
+    self.redraw()
+
+  def redraw(self):
+    '''
+    Fills the Listbox with the visible rows; also call this when the viewed state changed
+    '''
+    rows = self.items[self.offset:self.offset+self.height]
+    lb = self.listbox
+    lb.delete(0,tk.END)
+    if rows:
+      lb.insert(tk.END,*rows)
+    for n,target in enumerate(rows):
+      if target == self.current:
+        lb.itemconfig(n,bg='green',fg='black')
+      elif self.registry.isViewed(target):
+        lb.itemconfig(n,bg='blue',fg='white')
+    if self.items:
+      self.scrollbar.set(float(self.offset)/len(self.items),float(self.offset+len(rows))/len(self.items))
+    else:
+      self.scrollbar.set(0.0,1.0)
+    self.count.config(text="%s of %s targets" % (len(self.items),len(self.registry)))
+
+  def go(self):
+    selection = self.listbox.curselection()
+    if selection:
+      self.command(self.items[self.offset+int(selection[0])])
@@ -0,0 +1,114 @@
+'''
+In-memory registry of the targets under review.
+
+Keeps the review order together with a {target: position} index, so that membership
+and position lookups are O(1) instead of list scans. Band availability and the viewed
+and flagged state are cached per target, so the GUI does not have to stat files or query
+the database for them on every page.
+'''
+import os
+
+BANDS = 'grizJHK'
+IMAGE_SUFFIXES = ('', '.fz', '.gz') #plain, tile-compressed (fpack), gzipped; in order of preference
+
+
+def imagePath(target, band, suffix=''):
+  return os.path.join(target,'%s/GROND_%s_OB_ana.fits%s' % (band,band,suffix))
+
+
+def findImage(target, band):
+  '''
+  Returns the path of the (possibly compressed) image of band, or None
+  '''
+  for suffix in IMAGE_SUFFIXES:
+    img = imagePath(target,band,suffix)
+    if os.path.isfile(img):
+      return img
+  return None
+
+
+class TargetRegistry(object):
+
+  def __init__(self, targets=()):
+    self.targets = []
+    self.positions = {}
+    self.available = {}
+    self.viewed = {}
+    self.flagged = {}
+    self.extend(targets)
+
+  def __len__(self):
+    return len(self.targets)
+
+  def __iter__(self):
+    return iter(self.targets)
+
+  def __getitem__(self, i):
+    return self.targets[i]
+
+  def __contains__(self, target):
+    return target in self.positions
+
+  def index(self, target):
+    '''
+    Position of target in the review order; raises ValueError like list.index
+    '''
+    try:
+      return self.positions[target]
+    except KeyError:
+      raise ValueError("%s is not a known target" % target)
+
+  def append(self, target):
+    '''
+    Adds target at the end of the review order, unless it is already known.
+    Returns True if it was added.
+    '''
+    if target in self.positions:
+      return False
+    self.positions[target] = len(self.targets)
+    self.targets.append(target)
+    return True
+
+  def extend(self, targets):
+    '''
+    Returns the targets that were actually added
+    '''
+    return [t for t in targets if self.append(t)]
+
+  def images(self, target):
+    '''
+    Returns {band: FITS path or None} for target; the file system is only checked once
+    '''
+    if target not in self.available:
+      self.available[target] = dict((band,findImage(target,band)) for band in BANDS)
+    return self.available[target]
+
+  def invalidate(self, target):
+    '''
+    Forgets the cached band availability of target, e.g. after a new image was written
+    '''
+    self.available.pop(target,None)
+
+  def loadState(self, db):
+    '''
+    Reads the viewed and flagged state of all targets with a single query
+    '''
+    SQL = 'SELECT target, viewed, %s FROM Flags' % ', '.join(BANDS)
+    for row in db.execute(SQL):
+      self.viewed[row[0]] = bool(row[1])
+      self.flagged[row[0]] = any(row[2:])
+
+  def isViewed(self, target):
+    return self.viewed.get(target,False)
+
+  def setViewed(self, target, viewed=True):
+    self.viewed[target] = viewed
+
+  def isFlagged(self, target):
+    '''
+    Whether any flag is set for any band of target
+    '''
+    return self.flagged.get(target,False)
+
+  def setFlagged(self, target, flagged):
+    self.flagged[target] = flagged
@@ -0,0 +1,98 @@
+'''
+Persistent, content-addressed cache of the rendered thumbnails.
+
+A thumbnail is stored as <cachedir>/<key>.png, where the key is a hash of the FITS path,
+its size and mtime, and the render parameters (engine, size, colormap, stretch). The
+Thumbnails table maps every FITS file to its current key, so a relaunch only renders
+images that are new or changed and reuses all others. Mosaics of all bands of a target
+are stored the same way, under the target's path.
+'''
+import os
+import hashlib
+import time
+
+
+def thumbnailKey(fitsPath, params, st=None):
+  '''
+  params is a dict of the render parameters; st an os.stat() result of fitsPath
+  '''
+  if st is None:
+    st = os.stat(fitsPath)
+  s = '%s|%s|%r|%s' % (fitsPath,st.st_size,st.st_mtime,sorted(params.items()))
+  return hashlib.sha1(s).hexdigest()
+
+
+class ThumbnailCache(object):
+
+  def __init__(self, db, cachedir, params):
+    self.db = db
+    self.cachedir = cachedir
+    self.params = params
+    self.index = {}
+    self.superseded = {} #png being rendered: [the pngs it replaces]
+    for fits,key,png in db.execute('SELECT fits, key, png FROM Thumbnails'):
+      self.index[fits] = (key,png)
+
+  def lookup(self, fitsPath):
+    '''
+    Returns (png, key): png is the cached thumbnail of fitsPath, or None if it has to be
+    (re-)rendered to pngPath(key)
+    '''
+    try:
+      key = thumbnailKey(fitsPath,self.params)
+    except OSError:
+      return None, None
+    return self.cached(fitsPath,key), key
+
+  def lookupMosaic(self, target, fitsPaths):
+    '''
+    Like lookup, for the mosaic of the thumbnails of fitsPaths (None for a missing image).
+    Its key follows from theirs, so it is stale as soon as one of them is.
+    '''
+    keys = [self.index[f][0] if f in self.index else '' for f in fitsPaths]
+    key = hashlib.sha1('mosaic|%s' % '|'.join(keys)).hexdigest()
+    return self.cached(target,key), key
+
+  def cached(self, name, key):
+    cached = self.index.get(name)
+    if cached is not None and cached[0] == key and os.path.isfile(cached[1]):
+      return cached[1]
+    return None
+
+  def png(self, fitsPath):
+    '''
+    The recorded thumbnail of fitsPath (which may still be rendering), or None
+    '''
+    return self.index[fitsPath][1] if fitsPath in self.index else None
+
+  def written(self, png):
+    '''
+    Call once png has been rendered: deletes the thumbnails it replaces
+    '''
+    for old in self.superseded.pop(png,[]):
+      try:
+        os.remove(old)
+      except OSError:
+        pass
+
+  def pngPath(self, key):
+    return os.path.join(self.cachedir,'%s.png' % key)
+
+  def record(self, rows):
+    '''
+    Stores [(fitsPath, key)] of thumbnails being rendered; the thumbnails they replace
+    are deleted by written(), as they are still shown until then. A row whose PNG does not
+    exist (yet) is simply rendered again on the next launch.
+    '''
+    SQL = 'INSERT OR REPLACE INTO Thumbnails (fits, key, png, created) VALUES (?,?,?,?)'
+    now = time.time()
+    data = []
+    for fitsPath,key in rows:
+      png = self.pngPath(key)
+      old = self.index.get(fitsPath)
+      if old is not None and old[1] != png:
+        self.superseded[png] = self.superseded.pop(old[1],[])+[old[1]]
+      self.index[fitsPath] = (key,png)
+      data.append((fitsPath,key,png,now))
+    with self.db:
+      self.db.executemany(SQL,data)
@@ -0,0 +1,207 @@
+'''
+Tile pyramids for inspecting full-resolution frames.
+
+buildPyramid() cuts a FITS frame into 256x256 PNG tiles at full resolution and at every
+power-of-two binning down to a single tile. The frame is read memory-mapped, one row of
+tiles at a time, so it is never held in memory at full resolution.
+
+ZoomView is a Toplevel window that shows such a pyramid and can be zoomed (mouse wheel,
++/-) and panned (drag, scrollbars); it only loads the tiles that are visible.
+'''
+import os
+import json
+import math
+
+import numpy
+import Tkinter as tk
+from PIL import Image, ImageTk
+
+from lib import astImages
+
+TILE_SIZE = 256
+INFO_FILE = 'pyramid.json' #written last, so it marks a complete pyramid
+POLL_MS = 500
+
+
+def tilePath(pyramidDir, level, row, col):
+  return os.path.join(pyramidDir,str(level),'%s_%s.png' % (row,col))
+
+
+def loadInfo(pyramidDir):
+  '''
+  Returns the pyramid description, or None if the pyramid is not (completely) built
+  '''
+  try:
+    with open(os.path.join(pyramidDir,INFO_FILE)) as fp:
+      return json.load(fp)
+  except (IOError, ValueError):
+    return None
+
+
+def saveTiles(rgbRows, pyramidDir, level, row, tileSize):
+  d = os.path.join(pyramidDir,str(level))
+  if not os.path.isdir(d):
+    os.makedirs(d)
+  for col in range(int(math.ceil(rgbRows.shape[1]/float(tileSize)))):
+    tile = rgbRows[:,col*tileSize:(col+1)*tileSize]
+    Image.fromarray(tile,'RGB').save(tilePath(pyramidDir,level,row,col))
+
+
+def buildPyramid(inputFileName, pyramidDir, colorMapName, tileSize=TILE_SIZE):
+  '''
+  Writes the tiles of all levels of inputFileName to pyramidDir/<level>/<row>_<col>.png,
+  level 0 being full resolution and level n binned by 2**n. Rows count from the top of
+  the displayed image, which like the thumbnails has its origin at the bottom.
+  Returns (inputFileName, pyramidDir).
+  '''
+  lut = astImages.colorMapLUT(colorMapName)
+
+  def toRGB(data):
+    normed = (data-low)*((len(lut)-1)/(high-low))
+    normed[~numpy.isfinite(normed)] = 0
+    return lut[numpy.clip(normed,0,len(lut)-1).astype(numpy.uint8)]
+
+  fp,hdu = astImages.openImageHDU(inputFileName)
+  try:
+    #memory-mapped for plain files; compressed files are decompressed as a whole
+    data = hdu.data
+    low,high = [float(v) for v in astImages.cutLevels(data)]
+    if high <= low:
+      high = low+1.0
+    height,width = data.shape
+    #level 0 straight from the memory-mapped frame; its 2x2 binning is collected for level 1
+    binned = []
+    for row in range(int(math.ceil(height/float(tileSize)))):
+      top = height-row*tileSize
+      rows = numpy.array(data[max(0,top-tileSize):top][::-1],dtype=numpy.float32)
+      saveTiles(toRGB(rows),pyramidDir,0,row,tileSize)
+      binned.append(astImages.blockReduce(rows,2))
+  finally:
+    fp.close()
+  level = 0
+  while max(height,width) > tileSize:
+    level += 1
+    image = numpy.vstack(binned)
+    height,width = image.shape
+    for row in range(int(math.ceil(height/float(tileSize)))):
+      saveTiles(toRGB(image[row*tileSize:(row+1)*tileSize].copy()),pyramidDir,level,row,tileSize)
+    binned = [astImages.blockReduce(image,2)]
+  info = {'levels': level+1, 'tile_size': tileSize, 'width': data.shape[1], 'height': data.shape[0]}
+  with open(os.path.join(pyramidDir,INFO_FILE),'w') as fp:
+    json.dump(info,fp)
+  return inputFileName,pyramidDir
+
+
+class ZoomView(tk.Toplevel):
+
+  def __init__(self, master, pyramidDir, title, width=800, height=800, failed=None):
+    '''
+    failed() returns the error if building the pyramid failed, else None
+    '''
+    tk.Toplevel.__init__(self,master)
+    self.title(title)
+    self.pyramidDir = pyramidDir
+    self.failed = failed
+    self.info = None
+    self.level = None
+    self.tiles = {} #(level,row,col): (canvas item, PhotoImage)
+
+    vscrollbar = tk.Scrollbar(self)
+    vscrollbar.grid(row=0, column=1, sticky=tk.N+tk.S)
+    hscrollbar = tk.Scrollbar(self, orient=tk.HORIZONTAL)
+    hscrollbar.grid(row=1, column=0, sticky=tk.E+tk.W)
+    self.canvas = tk.Canvas(self,width=width,height=height,bg='white',
+                            xscrollcommand=lambda *a: self.scrolled(hscrollbar,*a),
+                            yscrollcommand=lambda *a: self.scrolled(vscrollbar,*a))
+    self.canvas.grid(row=0, column=0, sticky=tk.N+tk.S+tk.E+tk.W)
+    vscrollbar.config(command=self.canvas.yview)
+    hscrollbar.config(command=self.canvas.xview)
+    self.grid_rowconfigure(0, weight=1)
+    self.grid_columnconfigure(0, weight=1)
+    self.status = tk.Label(self,text="Building tiles...")
+    self.status.grid(row=2, column=0, sticky=tk.W)
+
+    self.canvas.bind('<ButtonPress-1>', lambda e: self.canvas.scan_mark(e.x,e.y))
+    self.canvas.bind('<B1-Motion>', self.dragged)
+    self.canvas.bind('<Configure>', lambda e: self.refreshTiles())
+    self.canvas.bind('<Button-4>', lambda e: self.zoom(-1,e.x,e.y))
+    self.canvas.bind('<Button-5>', lambda e: self.zoom(1,e.x,e.y))
+    self.canvas.bind('<MouseWheel>', lambda e: self.zoom(-1 if e.delta > 0 else 1,e.x,e.y))
+    self.bind('<plus>', lambda e: self.zoom(-1))
+    self.bind('<minus>', lambda e: self.zoom(1))
+    self.waitForPyramid()
+
+  def waitForPyramid(self):
+    self.info = loadInfo(self.pyramidDir)
+    if self.info is None:
+      error = self.failed() if self.failed is not None else None
+      if error:
+        self.status.config(text="Building the tiles failed: %s" % error.strip().splitlines()[-1],fg='red')
+        return
+      self.after(POLL_MS,self.waitForPyramid)
+      return
+    #start with the whole frame in view
+    self.setLevel(self.info['levels']-1)
+    self.status.config(text="Wheel or +/- to zoom, drag to pan")
+
+  def levelSize(self, level):
+    return int(math.ceil(self.info['width']/2.0**level)), int(math.ceil(self.info['height']/2.0**level))
+
+  def setLevel(self, level, fx=0.0, fy=0.0, x=0, y=0):
+    '''
+    Shows level such that the fraction (fx, fy) of the frame is at window position (x, y)
+    '''
+    self.level = level
+    for item,photo in self.tiles.values():
+      self.canvas.delete(item)
+    self.tiles = {}
+    w,h = self.levelSize(level)
+    self.canvas.config(scrollregion=(0,0,w,h))
+    self.canvas.xview_moveto(max(0.0,fx-float(x)/w))
+    self.canvas.yview_moveto(max(0.0,fy-float(y)/h))
+    self.status.config(text="Zoom 1:%s" % 2**level)
+    self.refreshTiles()
+
+  def zoom(self, step, x=None, y=None):
+    if self.info is None:
+      return
+    level = min(max(self.level+step,0),self.info['levels']-1)
+    if level == self.level:
+      return
+    if x is None:
+      x,y = self.canvas.winfo_width()//2, self.canvas.winfo_height()//2
+    w,h = self.levelSize(self.level)
+    fx,fy = self.canvas.canvasx(x)/w, self.canvas.canvasy(y)/h
+    self.setLevel(level,fx,fy,x,y)
+
+  def dragged(self, event):
+    self.canvas.scan_dragto(event.x,event.y,gain=1)
+    self.refreshTiles()
+
+  def scrolled(self, scrollbar, lo, hi):
+    scrollbar.set(lo,hi)
+    self.refreshTiles()
+
+  def refreshTiles(self):
+    '''
+    Loads the tiles in view and drops all others
+    '''
+    if self.info is None or self.level is None:
+      return
+    size = self.info['tile_size']
+    w,h = self.levelSize(self.level)
+    x0,y0 = self.canvas.canvasx(0), self.canvas.canvasy(0)
+    x1,y1 = x0+self.canvas.winfo_width(), y0+self.canvas.winfo_height()
+    visible = set()
+    for row in range(max(0,int(y0)//size),min(int(math.ceil(h/float(size))),int(y1)//size+1)):
+      for col in range(max(0,int(x0)//size),min(int(math.ceil(w/float(size))),int(x1)//size+1)):
+        key = (self.level,row,col)
+        visible.add(key)
+        if key not in self.tiles:
+          path = tilePath(self.pyramidDir,self.level,row,col)
+          if os.path.isfile(path):
+            photo = ImageTk.PhotoImage(Image.open(path))
+            item = self.canvas.create_image(col*size,row*size,anchor=tk.NW,image=photo)
+            self.tiles[key] = (item,photo)
+    for key in [k for k in self.tiles if k not in visible]:
+      self.canvas.delete(self.tiles.pop(key)[0])
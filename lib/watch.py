@@ -0,0 +1,174 @@
+'''
+Watches the data root for GROND_?_OB_ana.fits images written after startup.
+
+Uses inotify (through the optional pyinotify package) where possible. Without it, on
+network file systems (inotify misses files written by other clients), or when the tree
+needs more inotify watches than the kernel allows, the tree is polled: every poll is an
+incremental scan against the ScanIndex table (see discovery), so only directories whose
+mtime changed are listed again.
+
+A polled file is reported once its size and mtime were the same in two polls, so that
+files still being written are not rendered. The files found in changed directories are
+stat()ed in every poll from then on, and reported again when they are rewritten.
+
+New image paths are passed to a callback from the watcher thread; the callback must
+be thread safe (e.g. Queue.put).
+'''
+import os
+import re
+import time
+import sqlite3
+import threading
+
+from lib import discovery
+from lib import writer
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+POLL_SECONDS = 30.0
+
+
+class Watcher(object):
+
+  def __init__(self, database, root, regex, callback, interval=POLL_SECONDS, workers=1):
+    self.database = database
+    self.root = os.path.abspath(root)
+    self.regex = regex
+    self.callback = callback
+    self.interval = interval
+    self.workers = workers
+    self.mode = None
+    self.stats = {} #path: (size, mtime) in the last poll, of the files polled
+    self.reported = {} #path: (size, mtime) when last reported (or first seen)
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.stopped.set()
+
+  def run(self):
+    db = sqlite3.connect(self.database)
+    try:
+      notifier = self.startInotify()
+      #catch up with whatever was written between the startup scan and now; with inotify,
+      #files still being written are reported again by IN_CLOSE_WRITE
+      self.poll(db,settle=notifier is None)
+      if notifier is not None:
+        self.mode = 'inotify'
+        while not self.stopped.is_set():
+          if notifier.check_events(timeout=1000):
+            notifier.read_events()
+            notifier.process_events()
+        notifier.stop()
+      else:
+        self.mode = 'polling'
+        while not self.stopped.wait(self.interval):
+          self.poll(db)
+    finally:
+      db.close()
+
+  def poll(self, db, settle=True):
+    '''
+    Incremental scan: files of changed directories that are not in the scan index yet are
+    new, the others are only watched for changes from now on. Reports the new and changed
+    files whose size and mtime did not change since the last poll (right away with
+    settle=False), then updates the index.
+    '''
+    index = discovery.loadScanIndex(db,self.regex)
+    scanned = time.time()
+    entries = []
+    for entry in discovery.iterDirectories(self.root,self.regex,index,self.workers):
+      entries.append(entry)
+      path,mtime,subdirs,files,changed = entry
+      if changed:
+        known = set(index[path][3]) if path in index else set()
+        for f in files:
+          image = os.path.join(path,f)
+          if image not in self.stats:
+            self.stats[image] = None
+            if f in known:
+              self.reported[image] = fileStat(image)
+    ready = []
+    for image,last in self.stats.items():
+      st = fileStat(image)
+      if st is None:
+        del self.stats[image]
+        self.reported.pop(image,None)
+        continue
+      self.stats[image] = st
+      if (st == last or not settle) and st != self.reported.get(image):
+        self.reported[image] = st
+        ready.append(image)
+    if ready:
+      self.callback(sorted(ready))
+    discovery.saveScanIndex(db,self.root,self.regex,index,entries,scanned)
+
+  def startInotify(self):
+    '''
+    Returns a pyinotify Notifier watching the whole tree, or None if inotify is unavailable
+    '''
+    if pyinotify is None or writer.filesystemType(self.root) in writer.NETWORK_FILESYSTEMS:
+      return None
+    wm = pyinotify.WatchManager()
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+    notifier = pyinotify.Notifier(wm,EventHandler(watcher=self))
+    try:
+      wdd = wm.add_watch(self.root,mask,rec=True,auto_add=True,quiet=True)
+    except Exception:
+      wdd = {}
+    if not wdd or [wd for wd in wdd.values() if wd < 0]:
+      #typically fs.inotify.max_user_watches is too small for the tree
+      notifier.stop()
+      return None
+    return notifier
+
+  def report(self, path):
+    if re.search(self.regex,os.path.basename(path)):
+      self.callback([path])
+
+
+def fileStat(path):
+  '''
+  (size, mtime) of path, or None if it is gone
+  '''
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return st.st_size,st.st_mtime
+
+
+if pyinotify is not None:
+
+  class EventHandler(pyinotify.ProcessEvent):
+
+    def my_init(self, watcher):
+      self.watcher = watcher
+
+    def process_IN_CLOSE_WRITE(self, event):
+      self.watcher.report(event.pathname)
+
+    def process_IN_MOVED_TO(self, event):
+      if event.dir:
+        self.process_IN_CREATE(event)
+      else:
+        self.watcher.report(event.pathname)
+
+    def process_IN_CREATE(self, event):
+      '''
+      auto_add only watches a new directory after it was created, so files written into
+      it (or moved in with it) before that are picked up by listing it once
+      '''
+      if not event.dir:
+        return
+      for entry in discovery.iterDirectories(event.pathname,self.watcher.regex,{}):
+        path,files = entry[0],entry[3]
+        if files:
+          self.watcher.callback([os.path.join(path,f) for f in files])
@@ -0,0 +1,170 @@
+'''
+Write-behind persistence of the QA flags and review times.
+
+save() on the Tk thread only hands the changed columns to FlagWriter; a writer thread
+with its own connection commits them. Saves of a target that is still waiting are
+merged, so going back and forth costs one write. Rows added with insert() (ReviewTimes)
+go into the same transaction. close() (also run at exit) waits until
+everything is committed.
+
+The database is switched to WAL mode, so that the viewer keeps reading while the writer
+commits, except on network file systems, where SQLite does not support WAL. Commits are
+synchronous=FULL, so a committed save survives a crash or power loss.
+'''
+import os
+import time
+import atexit
+import sqlite3
+import threading
+
+TIMEOUT = 60.0 #seconds to wait for other connections holding the database
+RETRY_SECONDS = 1.0
+CLOSE_ATTEMPTS = 5
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'lustre', 'gpfs', 'fuse.sshfs', 'afs')
+
+
+def filesystemType(path):
+  '''
+  Type of the file system holding path, from /proc/mounts (Linux), or None
+  '''
+  path = os.path.realpath(path)
+  best = ('',None)
+  try:
+    with open('/proc/mounts') as fp:
+      for line in fp:
+        fields = line.split()
+        if len(fields) < 3:
+          continue
+        mountpoint = fields[1].replace('\\040',' ')
+        if (path == mountpoint or path.startswith(mountpoint.rstrip('/')+'/')) and len(mountpoint) >= len(best[0]):
+          best = (mountpoint,fields[2])
+  except IOError:
+    pass
+  return best[1]
+
+
+def walSupported(database):
+  return filesystemType(os.path.dirname(os.path.abspath(database))) not in NETWORK_FILESYSTEMS
+
+
+class FlagWriter(object):
+
+  def __init__(self, database):
+    self.database = database
+    self.pending = {} #target: {column: value}
+    self.inserts = [] #(table, {column: value})
+    self.cond = threading.Condition()
+    self.closed = False
+    self.journal = None
+    self.saves = 0
+    self.coalesced = 0
+    self.writes = 0
+    self.putSeconds = 0.0
+    self.commitSeconds = 0.0
+    self.lastCommit = None
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+    atexit.register(self.close)
+
+  def put(self, target, changes):
+    '''
+    Queues {column: value} to be written for target
+    '''
+    start = time.time()
+    with self.cond:
+      if target in self.pending:
+        self.coalesced += 1
+      self.pending.setdefault(target,{}).update(changes)
+      self.saves += 1
+      self.cond.notify()
+    self.putSeconds += time.time()-start
+
+  def insert(self, table, row):
+    '''
+    Queues a new row {column: value} of table
+    '''
+    with self.cond:
+      self.inserts.append((table,row))
+      self.cond.notify()
+
+  def run(self):
+    db = sqlite3.connect(self.database,timeout=TIMEOUT)
+    try:
+      if walSupported(self.database):
+        self.journal = db.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+      else:
+        self.journal = db.execute('PRAGMA journal_mode').fetchone()[0]
+      db.execute('PRAGMA synchronous=FULL')
+      failures = 0
+      while True:
+        with self.cond:
+          while not self.pending and not self.inserts and not self.closed:
+            self.cond.wait()
+          if not self.pending and not self.inserts:
+            break
+          batch,self.pending = self.pending,{}
+          inserts,self.inserts = self.inserts,[]
+        start = time.time()
+        try:
+          self.write(db,batch,inserts)
+          failures = 0
+        except sqlite3.Error, e:
+          failures += 1
+          with self.cond:
+            #keep the batch, under anything saved since
+            for target,changes in batch.iteritems():
+              changes.update(self.pending.get(target,{}))
+              self.pending[target] = changes
+            self.inserts[:0] = inserts
+            giveUp = self.closed and failures >= CLOSE_ATTEMPTS
+            if giveUp:
+              print "Could not save the flags of %s targets: %s" % (len(self.pending),e)
+              self.pending = {}
+              self.inserts = []
+          if not giveUp:
+            print "Saving flags failed (%s), retrying" % e
+            time.sleep(RETRY_SECONDS)
+          continue
+        with self.cond:
+          self.writes += 1
+          self.lastCommit = time.time()-start
+          self.commitSeconds += self.lastCommit
+    finally:
+      db.close()
+
+  def write(self, db, batch, inserts=()):
+    '''
+    Writes a batch in one transaction
+    '''
+    with db:
+      for target,changes in sorted(batch.iteritems()):
+        columns = sorted(changes)
+        SQL = 'UPDATE Flags SET %s WHERE target=?' % ', '.join('%s=?' % c for c in columns)
+        db.execute(SQL,[changes[c] for c in columns]+[target])
+      for table,row in inserts:
+        columns = sorted(row)
+        SQL = 'INSERT INTO %s (%s) VALUES (%s)' % (table,', '.join(columns),', '.join('?' for c in columns))
+        db.execute(SQL,[row[c] for c in columns])
+
+  def close(self):
+    '''
+    Commits everything queued and stops the writer thread; safe to call twice
+    '''
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+    self.thread.join()
+
+  def stats(self):
+    with self.cond:
+      return {
+        'journal': self.journal,
+        'pending': len(self.pending)+len(self.inserts),
+        'saves': self.saves,
+        'coalesced': self.coalesced,
+        'commits': self.writes,
+        'save_ms': self.putSeconds/self.saves*1000 if self.saves else None,
+        'commit_ms': self.commitSeconds/self.writes*1000 if self.writes else None,
+        'last_commit_ms': self.lastCommit*1000 if self.lastCommit is not None else None,
+      }